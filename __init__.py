@@ -1 +1,6 @@
-from . import models
\ No newline at end of file
+from . import models
+
+
+def post_init_hook(env):
+    env['sale.order.line']._backfill_storable_service_fields()
+    env['account.analytic.line']._backfill_timesheet_invoice_type()
@@ -1,6 +1,6 @@
 {
     'name': 'Storable Product as Service',
-    'version': '17.0.1.0.0',
+    'version': '17.0.1.1.0',
     'summary' : 'Add a product service feature',
     'category': 'Sales',
     'author': 'Mostafa Saad',
@@ -12,7 +12,12 @@
         'product'
     ],
     'data': [
+        'security/ir.model.access.csv',
+        'data/ir_cron_data.xml',
+        'data/ir_actions_server_data.xml',
         'views/product_views.xml',
+        'views/sale_order_views.xml',
+        'views/storable_service_job_views.xml',
     ],
 'images': [
         'static/description/icon.png',
@@ -25,4 +30,5 @@
     'application': False,
     'auto_install': False,
     'license': 'LGPL-3',
+    'post_init_hook': 'post_init_hook',
 }
\ No newline at end of file
@@ -0,0 +1,7 @@
+from odoo import api, SUPERUSER_ID
+
+
+def migrate(cr, version):
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['sale.order.line']._backfill_storable_service_fields()
+    env['account.analytic.line']._backfill_timesheet_invoice_type()
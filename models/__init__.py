@@ -1,8 +1,11 @@
 from . import account
 from . import product
 from . import project
+from . import project_profitability_snapshot
 from . import project_sale_line_employee_map
 from . import res_company
 from . import res_config_setting
 from . import sale_order
 from . import sale_order_line
+from . import storable_service_classification
+from . import storable_service_job
@@ -1,7 +1,12 @@
+from collections import defaultdict
+
 from odoo import api, models, _
 from odoo.osv import expression
 from odoo.tools.misc import unquote
 
+from .storable_service_classification import DELIVERED_TIMESHEET_INVOICE_TYPES, SERVICE_PRODUCT_TYPES
+from .utils import update_by_id_ranges
+
 TIMESHEET_INVOICE_TYPES = [
     ('billable_time', 'Billed on Timesheets'),
     ('billable_fixed', 'Billed at a Fixed price'),
@@ -14,6 +19,34 @@ TIMESHEET_INVOICE_TYPES = [
     ('other_costs', 'Other costs'),
 ]
 
+# Only lines sold with a storable product differ from what sale_timesheet computes.
+TIMESHEET_INVOICE_TYPE_BACKFILL_QUERY = """
+    WITH classified AS (
+        SELECT aal.id,
+               CASE
+                   WHEN aal.project_id IS NULL THEN
+                       CASE WHEN aal.amount >= 0 THEN 'service_revenues' ELSE 'other_costs' END
+                   WHEN pt.invoice_policy = 'delivery' AND pt.service_type = 'timesheet' THEN
+                       CASE WHEN aal.amount > 0 THEN 'timesheet_revenues' ELSE 'billable_time' END
+                   WHEN pt.invoice_policy = 'delivery' AND pt.service_type IN ('milestones', 'manual') THEN
+                       'billable_' || pt.service_type
+                   WHEN pt.invoice_policy IN ('delivery', 'order') THEN 'billable_fixed'
+               END AS invoice_type
+          FROM account_analytic_line aal
+          JOIN sale_order_line sol ON sol.id = aal.so_line
+          JOIN product_product pp ON pp.id = sol.product_id
+          JOIN product_template pt ON pt.id = pp.product_tmpl_id
+         WHERE aal.id >= %(id_from)s AND aal.id < %(id_to)s
+           AND pt.type = 'product'
+    )
+    UPDATE account_analytic_line aal
+       SET timesheet_invoice_type = classified.invoice_type
+      FROM classified
+     WHERE classified.id = aal.id
+       AND aal.timesheet_invoice_type IS DISTINCT FROM classified.invoice_type
+"""
+
+
 class AccountAnalyticLine(models.Model):
     _inherit = 'account.analytic.line'
 
@@ -37,30 +70,84 @@ class AccountAnalyticLine(models.Model):
             ('order_partner_id', 'child_of', self.sudo().commercial_partner_id.ids)
         ], super()._default_sale_line_domain()])
 
+    def _backfill_timesheet_invoice_type(self):
+        """ Reclassify the existing analytic lines sold with a storable product, see
+            :meth:`sale.order.line._backfill_storable_service_fields`.
+        """
+        self.env.flush_all()
+        update_by_id_ranges(
+            self.env, 'account_analytic_line', TIMESHEET_INVOICE_TYPE_BACKFILL_QUERY,
+            'account_analytic_line.timesheet_invoice_type')
+        self.invalidate_model(['timesheet_invoice_type'])
+
     @api.depends('so_line.product_id', 'project_id.billing_type', 'amount')
     def _compute_timesheet_invoice_type(self):
+        for invoice_type, timesheet_ids in self._get_timesheet_ids_per_invoice_type().items():
+            self.browse(timesheet_ids).timesheet_invoice_type = invoice_type
+
+    def _get_timesheet_ids_per_invoice_type(self):
+        """ Group the timesheets by the values their invoice type depends on and resolve each distinct
+            combination once, see :meth:`_get_timesheet_invoice_type_from_key`.
+
+            :returns: a dict with the invoice type as key and the list of timesheet ids as value
+        """
+        self.so_line.product_id.fetch(['type', 'invoice_policy', 'service_type'])
+        self.project_id.fetch(['billing_type'])
+        timesheet_ids_per_key = defaultdict(list)
         for timesheet in self:
-            if timesheet.project_id:  # AAL will be set to False
-                invoice_type = False
-                if not timesheet.so_line:
-                    invoice_type = 'non_billable' if timesheet.project_id.billing_type != 'manually' else 'billable_manual'
-                elif timesheet.so_line.product_id.type in ['service', 'product']:
-                    if timesheet.so_line.product_id.invoice_policy == 'delivery':
-                        if timesheet.so_line.product_id.service_type == 'timesheet':
-                            invoice_type = 'timesheet_revenues' if timesheet.amount > 0 else 'billable_time'
-                        else:
-                            service_type = timesheet.so_line.product_id.service_type
-                            invoice_type = f'billable_{service_type}' if service_type in ['milestones',
-                                                                                          'manual'] else 'billable_fixed'
-                    elif timesheet.so_line.product_id.invoice_policy == 'order':
-                        invoice_type = 'billable_fixed'
-                timesheet.timesheet_invoice_type = invoice_type
-            else:
-                if timesheet.amount >= 0:
-                    if timesheet.so_line and timesheet.so_line.product_id.type in ['service', 'product']:
-                        timesheet.timesheet_invoice_type = 'service_revenues'
-                    else:
-                        timesheet.timesheet_invoice_type = 'other_revenues'
-                else:
-                    timesheet.timesheet_invoice_type = 'other_costs'
+            product = timesheet.so_line.product_id
+            key = (
+                bool(timesheet.project_id),
+                timesheet.project_id.billing_type,
+                bool(timesheet.so_line),
+                product.type in SERVICE_PRODUCT_TYPES,
+                product.invoice_policy,
+                product.service_type,
+                (timesheet.amount > 0) - (timesheet.amount < 0),
+            )
+            timesheet_ids_per_key[key].append(timesheet.id)
+        classification = self.env['storable.service.classification']
+        timesheet_ids_per_invoice_type = defaultdict(list)
+        for key, timesheet_ids in timesheet_ids_per_key.items():
+            timesheet_ids_per_invoice_type[classification._get_timesheet_invoice_type(*key)] += timesheet_ids
+        return timesheet_ids_per_invoice_type
+
+    def _update_outdated_timesheet_invoice_type(self):
+        """ Store the invoice type of the timesheets whose value is outdated, skipping the others
+
+            :returns: the number of updated timesheets
+        """
+        stored_invoice_types = {timesheet.id: timesheet.timesheet_invoice_type for timesheet in self}
+        updated_count = 0
+        for invoice_type, timesheet_ids in self._get_timesheet_ids_per_invoice_type().items():
+            outdated_ids = tuple(
+                timesheet_id for timesheet_id in timesheet_ids
+                if stored_invoice_types[timesheet_id] != invoice_type
+            )
+            if outdated_ids:
+                self.env.cr.execute(
+                    "UPDATE account_analytic_line SET timesheet_invoice_type = %s WHERE id IN %s",
+                    [invoice_type or None, outdated_ids],
+                )
+                updated_count += len(outdated_ids)
+        self.invalidate_recordset(['timesheet_invoice_type'])
+        return updated_count
 
+    @api.model
+    def _get_timesheet_invoice_type_from_key(self, has_project, billing_type, has_so_line, is_service,
+                                             invoice_policy, service_type, amount_sign):
+        if not has_project:
+            if amount_sign < 0:
+                return 'other_costs'
+            return 'service_revenues' if has_so_line and is_service else 'other_revenues'
+        if not has_so_line:
+            return 'non_billable' if billing_type != 'manually' else 'billable_manual'
+        if not is_service:
+            return False
+        if invoice_policy == 'order':
+            return 'billable_fixed'
+        if invoice_policy != 'delivery':
+            return False
+        if service_type == 'timesheet':
+            return 'timesheet_revenues' if amount_sign > 0 else 'billable_time'
+        return DELIVERED_TIMESHEET_INVOICE_TYPES.get(service_type, 'billable_fixed')
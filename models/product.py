@@ -1,4 +1,59 @@
-from odoo import api, models, _
+from odoo import api, models, _lt
+
+# tooltip of the products sold as services or storable products, per (service policy, service tracking)
+PRODUCT_TOOLTIPS = {
+    ('ordered_prepaid', 'no'): _lt(
+        "Invoice ordered quantities as soon as this service is sold."
+    ),
+    ('ordered_prepaid', 'task_global_project'): _lt(
+        "Invoice ordered quantities as soon as this service is sold. "
+        "Create a task in an existing project to track the time spent."
+    ),
+    ('ordered_prepaid', 'project_only'): _lt(
+        "Invoice ordered quantities as soon as this service is sold. "
+        "Create an empty project for the order to track the time spent."
+    ),
+    ('ordered_prepaid', 'task_in_project'): _lt(
+        "Invoice ordered quantities as soon as this service is sold. "
+        "Create a project for the order with a task for each sales order line "
+        "to track the time spent."
+    ),
+    ('delivered_milestones', 'no'): _lt(
+        "Invoice your milestones when they are reached."
+    ),
+    ('delivered_milestones', 'task_global_project'): _lt(
+        "Invoice your milestones when they are reached. "
+        "Create a task in an existing project to track the time spent."
+    ),
+    ('delivered_milestones', 'project_only'): _lt(
+        "Invoice your milestones when they are reached. "
+        "Create an empty project for the order to track the time spent."
+    ),
+    ('delivered_milestones', 'task_in_project'): _lt(
+        "Invoice your milestones when they are reached. "
+        "Create a project for the order with a task for each sales order line "
+        "to track the time spent."
+    ),
+    ('delivered_manual', 'no'): _lt(
+        "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
+    ),
+    ('delivered_manual', 'task_global_project'): _lt(
+        "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
+        "Create a task in an existing project to track the time spent."
+    ),
+    ('delivered_manual', 'project_only'): _lt(
+        "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
+        "Create an empty project for the order to track the time spent."
+    ),
+    ('delivered_manual', 'task_in_project'): _lt(
+        "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
+        "Create a project for the order with a task for each sales order line "
+        "to track the time spent."
+    ),
+}
+
+# product fields the invoice type of the timesheets and of the project revenues depend on
+TIMESHEET_INVOICE_TYPE_PRODUCT_FIELDS = ('type', 'invoice_policy', 'service_type', 'service_policy')
 
 
 class ProductTemplate(models.Model):
@@ -6,78 +61,25 @@ class ProductTemplate(models.Model):
 
     @api.depends('invoice_policy', 'service_type', 'type')
     def _compute_service_policy(self):
+        classification = self.env['storable.service.classification']
         for product in self:
-            product.service_policy = self._get_general_to_service(product.invoice_policy, product.service_type)
-            if not product.service_policy and product.type in ['service', 'product']:
-                product.service_policy = 'ordered_prepaid'
+            product.service_policy = classification._get_service_policy(
+                product.type, product.invoice_policy, product.service_type)
 
     @api.depends('service_tracking', 'service_policy', 'type', 'sale_ok')
     def _compute_product_tooltip(self):
         super()._compute_product_tooltip()
-        for record in self.filtered(lambda record: record.type in ['service', 'product'] and record.sale_ok):
-            if record.service_policy == 'ordered_prepaid':
-                if record.service_tracking == 'no':
-                    record.product_tooltip = _(
-                        "Invoice ordered quantities as soon as this service is sold."
-                    )
-                elif record.service_tracking == 'task_global_project':
-                    record.product_tooltip = _(
-                        "Invoice ordered quantities as soon as this service is sold. "
-                        "Create a task in an existing project to track the time spent."
-                    )
-                elif record.service_tracking == 'project_only':
-                    record.product_tooltip = _(
-                        "Invoice ordered quantities as soon as this service is sold. "
-                        "Create an empty project for the order to track the time spent."
-                    )
-                elif record.service_tracking == 'task_in_project':
-                    record.product_tooltip = _(
-                        "Invoice ordered quantities as soon as this service is sold. "
-                        "Create a project for the order with a task for each sales order line "
-                        "to track the time spent."
-                    )
-            elif record.service_policy == 'delivered_milestones':
-                if record.service_tracking == 'no':
-                    record.product_tooltip = _(
-                        "Invoice your milestones when they are reached."
-                    )
-                elif record.service_tracking == 'task_global_project':
-                    record.product_tooltip = _(
-                        "Invoice your milestones when they are reached. "
-                        "Create a task in an existing project to track the time spent."
-                    )
-                elif record.service_tracking == 'project_only':
-                    record.product_tooltip = _(
-                        "Invoice your milestones when they are reached. "
-                        "Create an empty project for the order to track the time spent."
-                    )
-                elif record.service_tracking == 'task_in_project':
-                    record.product_tooltip = _(
-                        "Invoice your milestones when they are reached. "
-                        "Create a project for the order with a task for each sales order line "
-                        "to track the time spent."
-                    )
-            elif record.service_policy == 'delivered_manual':
-                if record.service_tracking == 'no':
-                    record.product_tooltip = _(
-                        "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
-                    )
-                elif record.service_tracking == 'task_global_project':
-                    record.product_tooltip = _(
-                        "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
-                        "Create a task in an existing project to track the time spent."
-                    )
-                elif record.service_tracking == 'project_only':
-                    record.product_tooltip = _(
-                        "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
-                        "Create an empty project for the order to track the time spent."
-                    )
-                elif record.service_tracking == 'task_in_project':
-                    record.product_tooltip = _(
-                        "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
-                        "Create a project for the order with a task for each sales order line "
-                        "to track the time spent."
-                    )
+        records = self.filtered(lambda record: record.type in ['service', 'product'] and record.sale_ok)
+        keys = {(record.service_policy, record.service_tracking) for record in records}
+        # each message is translated once per batch, in the language of the environment
+        tooltip_per_key = {}
+        for key in keys:
+            if key in PRODUCT_TOOLTIPS:
+                tooltip_per_key[key] = str(PRODUCT_TOOLTIPS[key])
+        for record in records:
+            tooltip = tooltip_per_key.get((record.service_policy, record.service_tracking))
+            if tooltip:
+                record.product_tooltip = tooltip
 
     @api.onchange('service_policy')
     def _inverse_service_policy(self):
@@ -99,7 +101,12 @@ class ProductTemplate(models.Model):
                 'service_tracking': 'no',
                 'project_id': False
             })
-        return super(ProductTemplate, self).write(vals)
+        res = super(ProductTemplate, self).write(vals)
+        if any(fname in vals for fname in TIMESHEET_INVOICE_TYPE_PRODUCT_FIELDS):
+            # the timesheets already sold with these products are reclassified in the background
+            products = self.with_context(active_test=False).product_variant_ids
+            self.env['storable.service.job']._enqueue_timesheet_invoice_type(products)
+        return res
 
 class ProductProduct(models.Model):
     _inherit = 'product.product'
@@ -1,6 +1,7 @@
 import json
+from datetime import timedelta
 
-from odoo import api, fields, models, _, _lt
+from odoo import api, fields, models, Command, _, _lt
 from collections import defaultdict
 from odoo.osv import expression
 from urllib.parse import unquote
@@ -24,6 +25,13 @@ class Project(models.Model):
         check_company=True,
         compute="_compute_timesheet_product_id", store=True, readonly=False,
         default=_default_timesheet_product_id)
+    profitability_snapshot_date = fields.Datetime(
+        "Profitability Snapshot Date", copy=False, readonly=True, index='btree_not_null',
+        help="Last full rebuild of the profitability snapshot of the project.")
+    profitability_snapshot_sale_line_ids = fields.Many2many(
+        'sale.order.line', 'project_profitability_snapshot_sale_line_rel', 'project_id', 'sale_line_id',
+        string="Profitability Snapshot Sale Items", copy=False, readonly=True,
+        help="Sale order items of the project when its profitability snapshot was last updated.")
 
     def _domain_sale_line_id(self):
         domain = expression.AND([
@@ -40,19 +48,62 @@ class Project(models.Model):
     @api.depends('partner_id')
     def _compute_sale_line_id(self):
         super()._compute_sale_line_id()
-        for project in self.filtered(
-                lambda p: not p.sale_line_id and p.partner_id and p.pricing_type == 'employee_rate'):
-            # Give a SOL by default either the last SOL with service product and remaining_hours > 0
-            sol = self.env['sale.order.line'].search([
-                ('order_partner_id', 'child_of', project.partner_id.commercial_partner_id.id),
-                ('is_expense', '=', False),
-                ('state', '=', 'sale'),
-                ('remaining_hours', '>', 0)
-            ], limit=1)
+        projects = self.filtered(
+            lambda p: not p.sale_line_id and p.partner_id and p.pricing_type == 'employee_rate')
+        if not projects:
+            return
+        # Give a SOL by default either the last SOL with service product and remaining_hours > 0
+        sol_per_commercial_partner = self.env['sale.order.line']._get_last_sol_per_commercial_partner(
+            projects.partner_id.commercial_partner_id)
+        for project in projects:
+            sol = sol_per_commercial_partner.get(project.partner_id.commercial_partner_id.id)
             project.sale_line_id = sol or project.sale_line_employee_ids.sale_line_id[
                                           :1]  # get the first SOL containing in the employee
 
+    def _convert_profitability_amount(self, amount, currency, company, round=True):
+        """ Convert ``amount`` from ``currency`` to the currency of ``company`` at today's rate, as
+            ``currency._convert`` does, but resolve each rate once per request. The cache lives on the
+            cursor and is used by the revenue sections computed from the sale order items, live or from
+            the snapshot; the cost sections of sale_project and sale_timesheet still convert on their own.
+        """
+        if not amount:
+            return 0.0
+        to_currency = company.currency_id
+        date = fields.Date.context_today(self)
+        key = (currency.id, to_currency.id, company.id, date)
+        rates = self.env.cr.cache.setdefault('project_profitability_rates', {})
+        if key not in rates:
+            rates[key] = currency._get_conversion_rate(currency, to_currency, company, date)
+        to_amount = amount * rates[key]
+        return to_currency.round(to_amount) if round else to_amount
+
+    def _get_profitability_invoice_type_per_product(self, product_ids):
+        """ Classify the given products into the revenue sections of the profitability panel
+
+            :returns: a dict with the product id as key and, as value, a tuple with the index of its
+                (invoice policy, service type, type) group, as read by ``_read_group``, and its invoice type
+        """
+        product_read_group = self.env['product.product'].sudo()._read_group(
+            [('id', 'in', product_ids)],
+            ['invoice_policy', 'service_type', 'type'],
+            ['id:array_agg'],
+        )
+        classification = self.env['storable.service.classification']
+        group_and_invoice_type_per_product = {}
+        for group_index, (invoice_policy, service_type, type_, group_product_ids) in enumerate(product_read_group):
+            invoice_type = classification._get_profitability_invoice_type(type_, invoice_policy, service_type)
+            for product_id in group_product_ids:
+                group_and_invoice_type_per_product[product_id] = (group_index, invoice_type)
+        return group_and_invoice_type_per_product
+
+    def _get_profitability_items(self, with_action=True):
+        # the revenues of the panel can be read from the profitability snapshot
+        return super(Project, self.with_context(profitability_from_snapshot=True))._get_profitability_items(with_action)
+
     def _get_revenues_items_from_sol(self, domain=None, with_action=True):
+        if len(self) == 1 and self.env.context.get('profitability_from_snapshot') \
+                and self._filter_fresh_profitability_snapshot():
+            return self._get_revenues_items_from_sol_snapshot(domain, with_action)
         sale_line_read_group = self.env['sale.order.line'].sudo()._read_group(
             self._get_profitability_sale_order_items_domain(domain),
             ['currency_id', 'product_id', 'is_downpayment'],
@@ -72,11 +123,11 @@ class Project(models.Model):
             downpayment_sol_ids = []
             for currency, product, is_downpayment, sol_ids, untaxed_amount_to_invoice, untaxed_amount_invoiced in sale_line_read_group:
                 if is_downpayment:
-                    downpayment_amount_invoiced += currency._convert(untaxed_amount_invoiced, convert_company.currency_id, convert_company, round=False)
+                    downpayment_amount_invoiced += self._convert_profitability_amount(untaxed_amount_invoiced, currency, convert_company, round=False)
                     downpayment_sol_ids += sol_ids
                 else:
-                    sols_per_product[product.id][0] += currency._convert(untaxed_amount_to_invoice, convert_company.currency_id, convert_company)
-                    sols_per_product[product.id][1] += currency._convert(untaxed_amount_invoiced, convert_company.currency_id, convert_company)
+                    sols_per_product[product.id][0] += self._convert_profitability_amount(untaxed_amount_to_invoice, currency, convert_company)
+                    sols_per_product[product.id][1] += self._convert_profitability_amount(untaxed_amount_invoiced, currency, convert_company)
                     sols_per_product[product.id][2] += sol_ids
             if downpayment_amount_invoiced:
                 downpayments_data = {
@@ -85,62 +136,247 @@ class Project(models.Model):
                     'invoiced': downpayment_amount_invoiced,
                     'to_invoice': -downpayment_amount_invoiced
                 }
-                if with_action and self.user_has_groups('sales_team.group_sale_salesman_all_leads, account.group_account_invoice, account.group_account_readonly'):
-                    invoices = self.env['account.move'].search([('line_ids.sale_line_ids', 'in', downpayment_sol_ids)])
-                    args = ['downpayments', [('id', 'in', invoices.ids)]]
-                    if len(invoices) == 1:
-                        args.append(invoices.id)
-                    downpayments_data['action'] = {
-                        'name': 'action_profitability_items',
-                        'type': 'object',
-                        'args': json.dumps(args),
-                    }
+                downpayments_action = with_action and self._get_downpayments_profitability_action(downpayment_sol_ids)
+                if downpayments_action:
+                    downpayments_data['action'] = downpayments_action
                 data += [downpayments_data]
                 total_invoiced += downpayment_amount_invoiced
                 total_to_invoice -= downpayment_amount_invoiced
-            product_read_group = self.env['product.product'].sudo()._read_group(
-                [('id', 'in', list(sols_per_product))],
-                ['invoice_policy', 'service_type', 'type'],
-                ['id:array_agg'],
-            )
-            service_policy_to_invoice_type = self._get_service_policy_to_invoice_type()
-            general_to_service_map = self.env['product.template']._get_general_to_service_map()
-            for invoice_policy, service_type, type_, product_ids in product_read_group:
-                service_policy = None
-                if type_ in ['service','product']:
-                    service_policy = general_to_service_map.get(
-                        (invoice_policy, service_type),
-                        'ordered_prepaid')
-                for product_id, (amount_to_invoice, amount_invoiced, sol_ids) in sols_per_product.items():
-                    if product_id in product_ids:
-                        invoice_type = service_policy_to_invoice_type.get(service_policy, 'materials')
-                        revenue = revenues_dict.setdefault(invoice_type, {'invoiced': 0.0, 'to_invoice': 0.0})
-                        revenue['to_invoice'] += amount_to_invoice
-                        total_to_invoice += amount_to_invoice
-                        revenue['invoiced'] += amount_invoiced
-                        total_invoiced += amount_invoiced
-                        if display_sol_action and invoice_type in ['service_revenues', 'materials']:
-                            revenue.setdefault('record_ids', []).extend(sol_ids)
+            group_and_invoice_type_per_product = self._get_profitability_invoice_type_per_product(list(sols_per_product))
+            # walk the products group after group, as the revenues and their records are listed in that order
+            for product_id in sorted(
+                    (product_id for product_id in sols_per_product if product_id in group_and_invoice_type_per_product),
+                    key=group_and_invoice_type_per_product.__getitem__):
+                amount_to_invoice, amount_invoiced, sol_ids = sols_per_product[product_id]
+                invoice_type = group_and_invoice_type_per_product[product_id][1]
+                revenue = revenues_dict.setdefault(invoice_type, {'invoiced': 0.0, 'to_invoice': 0.0})
+                revenue['to_invoice'] += amount_to_invoice
+                total_to_invoice += amount_to_invoice
+                revenue['invoiced'] += amount_invoiced
+                total_invoiced += amount_invoiced
+                if display_sol_action and invoice_type in ['service_revenues', 'materials']:
+                    revenue.setdefault('record_ids', []).extend(sol_ids)
 
             if display_sol_action:
-                section_name = 'materials'
-                materials = revenues_dict.get(section_name, {})
-                sale_order_items = self.env['sale.order.line'] \
-                    .browse(materials.pop('record_ids', [])) \
-                    ._filter_access_rules_python('read')
-                if sale_order_items:
-                    args = [section_name, [('id', 'in', sale_order_items.ids)]]
-                    if len(sale_order_items) == 1:
-                        args.append(sale_order_items.id)
-                    action_params = {
-                        'name': 'action_profitability_items',
-                        'type': 'object',
-                        'args': json.dumps(args),
-                    }
-                    if len(sale_order_items) == 1:
-                        action_params['res_id'] = sale_order_items.id
-                    materials['action'] = action_params
+                materials = revenues_dict.get('materials', {})
+                materials_action = self._get_materials_profitability_action(materials.pop('record_ids', []))
+                if materials_action:
+                    materials['action'] = materials_action
+        sequence_per_invoice_type = self._get_profitability_sequence_per_invoice_type()
+        data += [{
+            'id': invoice_type,
+            'sequence': sequence_per_invoice_type[invoice_type],
+            **vals,
+        } for invoice_type, vals in revenues_dict.items()]
+        return {
+            'data': data,
+            'total': {'to_invoice': total_to_invoice, 'invoiced': total_invoiced},
+        }
+
+    def _get_downpayments_profitability_action(self, downpayment_sol_ids):
+        if not self.user_has_groups('sales_team.group_sale_salesman_all_leads, account.group_account_invoice, account.group_account_readonly'):
+            return False
+        invoices = self.env['account.move'].search([('line_ids.sale_line_ids', 'in', downpayment_sol_ids)])
+        args = ['downpayments', [('id', 'in', invoices.ids)]]
+        if len(invoices) == 1:
+            args.append(invoices.id)
+        return {
+            'name': 'action_profitability_items',
+            'type': 'object',
+            'args': json.dumps(args),
+        }
+
+    def _get_materials_profitability_action(self, sol_ids):
+        section_name = 'materials'
+        sale_order_items = self.env['sale.order.line'].browse(sol_ids)._filter_access_rules_python('read')
+        if not sale_order_items:
+            return False
+        args = [section_name, [('id', 'in', sale_order_items.ids)]]
+        if len(sale_order_items) == 1:
+            args.append(sale_order_items.id)
+        action_params = {
+            'name': 'action_profitability_items',
+            'type': 'object',
+            'args': json.dumps(args),
+        }
+        if len(sale_order_items) == 1:
+            action_params['res_id'] = sale_order_items.id
+        return action_params
+
+    def _get_revenues_items_from_sol_snapshot(self, domain=None, with_action=True):
+        """ Same as :meth:`_get_revenues_items_from_sol` for the project, with the amounts read from its
+            fresh profitability snapshot: only the ids of the sale order items are read for the actions.
+        """
+        self.ensure_one()
+        revenues = self._get_revenues_items_from_snapshot()[self.id]
+        if not with_action:
+            return revenues
+        sale_line_read_group = self.env['sale.order.line'].sudo()._read_group(
+            self._get_profitability_sale_order_items_domain(domain),
+            ['product_id', 'is_downpayment'],
+            ['id:array_agg'],
+        )
+        downpayment_sol_ids = []
+        sol_ids_per_product = defaultdict(list)
+        for product, is_downpayment, sol_ids in sale_line_read_group:
+            if is_downpayment:
+                downpayment_sol_ids += sol_ids
+            else:
+                sol_ids_per_product[product.id] += sol_ids
+        revenue_per_invoice_type = {revenue['id']: revenue for revenue in revenues['data']}
+        if 'downpayments' in revenue_per_invoice_type:
+            downpayments_action = self._get_downpayments_profitability_action(downpayment_sol_ids)
+            if downpayments_action:
+                revenue_per_invoice_type['downpayments']['action'] = downpayments_action
+        if self.user_has_groups('sales_team.group_sale_salesman'):
+            group_and_invoice_type_per_product = self._get_profitability_invoice_type_per_product(list(sol_ids_per_product))
+            for product_id in sorted(
+                    (product_id for product_id in sol_ids_per_product if product_id in group_and_invoice_type_per_product),
+                    key=group_and_invoice_type_per_product.__getitem__):
+                invoice_type = group_and_invoice_type_per_product[product_id][1]
+                if invoice_type in ['service_revenues', 'materials'] and invoice_type in revenue_per_invoice_type:
+                    revenue_per_invoice_type[invoice_type].setdefault('record_ids', []).extend(sol_ids_per_product[product_id])
+            materials = revenue_per_invoice_type.get('materials', {})
+            materials_action = self._get_materials_profitability_action(materials.pop('record_ids', []))
+            if materials_action:
+                materials['action'] = materials_action
+        return revenues
+
+    def _get_revenues_items_from_sol_per_project(self, domain=None, use_snapshot=True):
+        """ Compute the revenues of several projects with a fixed number of queries
+
+            The sale order items of a project are chosen as the profitability panel of sale_project does:
+            the items of the sales orders the project sells, which either belong to the project, to no
+            project, or are sale order items of the project. The revenues of each project have the shape
+            returned by :meth:`_get_revenues_items_from_sol`, without the actions. Without extra domain,
+            the projects whose profitability snapshot is fresh are read from it.
+
+            :param domain: extra domain on the sale order items
+            :param use_snapshot: whether the fresh profitability snapshots can be used
+            :returns: a dict with the project id as key and the revenues as value
+        """
+        if domain is None and use_snapshot:
+            snapshot_projects = self._filter_fresh_profitability_snapshot()
+            revenues_per_project = snapshot_projects._get_revenues_items_from_snapshot()
+            if snapshot_projects:
+                revenues_per_project.update(
+                    (self - snapshot_projects)._get_revenues_items_from_sol_per_project(use_snapshot=False))
+                return revenues_per_project
+        amounts_per_project, __ = self._get_profitability_sale_line_amounts_per_project(domain)
+        group_and_invoice_type_per_product = self._get_profitability_invoice_type_per_product(list({
+            product_id
+            for amounts_per_key in amounts_per_project.values()
+            for (__, product_id, is_downpayment) in amounts_per_key if not is_downpayment
+        }))
+        return {
+            project.id: project._get_revenues_items_from_sale_line_amounts(
+                amounts_per_project.get(project.id, {}), group_and_invoice_type_per_product)
+            for project in self
+        }
+
+    def _get_profitability_sale_line_amounts_per_project(self, domain=None):
+        """ Sum the amounts of the sale order items of each project, chosen as by the profitability panel
+
+            :param domain: extra domain on the sale order items
+            :returns: a tuple with
+
+                - a dict with the project id as key and, as value, a dict with a (currency id, product id,
+                  is downpayment) tuple as key and the [to invoice, invoiced, count] amounts of these items,
+                  in their currency, as value
+                - a dict with the project id as key and its sale order items as value, as returned by
+                  ``_fetch_sale_order_items_per_project_id``
+        """
+        sale_items_per_project = self.sudo()._fetch_sale_order_items_per_project_id()
+        order_ids_per_project = {
+            project_id: set(sale_items.order_id.ids)
+            for project_id, sale_items in sale_items_per_project.items()
+        }
+        project_ids_per_order = defaultdict(list)
+        for project_id, order_ids in order_ids_per_project.items():
+            for order_id in order_ids:
+                project_ids_per_order[order_id].append(project_id)
+        amounts_per_project = defaultdict(lambda: defaultdict(lambda: [0.0, 0.0, 0]))
+        if not project_ids_per_order:
+            return amounts_per_project, sale_items_per_project
+        items_domain = self._get_profitability_sale_order_items_domain(domain)
+        # grouped by currency and product first, as the panel reads them
+        sale_line_read_group = self.env['sale.order.line'].sudo()._read_group(
+            expression.AND([items_domain, [('order_id', 'in', list(project_ids_per_order))]]),
+            ['currency_id', 'product_id', 'is_downpayment', 'order_id', 'project_id'],
+            ['__count', 'untaxed_amount_to_invoice:sum', 'untaxed_amount_invoiced:sum'],
+        )
+        for currency, product, is_downpayment, order, line_project, count, to_invoice, invoiced in sale_line_read_group:
+            for project_id in project_ids_per_order[order.id]:
+                if not line_project or line_project.id == project_id:
+                    amounts = amounts_per_project[project_id][currency.id, product.id, is_downpayment]
+                    amounts[0] += to_invoice
+                    amounts[1] += invoiced
+                    amounts[2] += count
+        # the sale order items of a project count for it even when they belong to another project
+        other_project_item_ids_per_project = {
+            project_id: set(sale_items.filtered(
+                lambda sol: sol.project_id and sol.project_id.id != project_id).ids)
+            for project_id, sale_items in sale_items_per_project.items()
+        }
+        other_project_item_ids = set().union(*other_project_item_ids_per_project.values())
+        if other_project_item_ids:
+            other_project_items = self.env['sale.order.line'].sudo().search_fetch(
+                expression.AND([items_domain, [('id', 'in', list(other_project_item_ids))]]),
+                ['currency_id', 'product_id', 'is_downpayment', 'untaxed_amount_to_invoice', 'untaxed_amount_invoiced'],
+            )
+            for project_id, item_ids in other_project_item_ids_per_project.items():
+                for sol in other_project_items.filtered(lambda sol: sol.id in item_ids):
+                    amounts = amounts_per_project[project_id][sol.currency_id.id, sol.product_id.id, sol.is_downpayment]
+                    amounts[0] += sol.untaxed_amount_to_invoice
+                    amounts[1] += sol.untaxed_amount_invoiced
+                    amounts[2] += 1
+        return amounts_per_project, sale_items_per_project
+
+    def _get_revenues_items_from_sale_line_amounts(self, amounts_per_key, group_and_invoice_type_per_product):
+        """ Build the revenues of the project, as :meth:`_get_revenues_items_from_sol` without the actions,
+            from the amounts of its sale order items
+
+            :param amounts_per_key: the amounts of the project, as returned by
+                :meth:`_get_profitability_sale_line_amounts_per_project`
+            :param group_and_invoice_type_per_product: the classification of the products, as returned by
+                :meth:`_get_profitability_invoice_type_per_product`
+        """
+        self.ensure_one()
+        convert_company = self.company_id or self.env.company
+        currency_per_id = {currency.id: currency for currency in self.env['res.currency'].browse(
+            {currency_id for currency_id, __, __ in amounts_per_key})}
+        sols_per_product = defaultdict(lambda: [0.0, 0.0])
+        downpayment_amount_invoiced = 0
+        for (currency_id, product_id, is_downpayment), (to_invoice, invoiced, __) in amounts_per_key.items():
+            currency = currency_per_id[currency_id]
+            if is_downpayment:
+                downpayment_amount_invoiced += self._convert_profitability_amount(invoiced, currency, convert_company, round=False)
+            else:
+                sols_per_product[product_id][0] += self._convert_profitability_amount(to_invoice, currency, convert_company)
+                sols_per_product[product_id][1] += self._convert_profitability_amount(invoiced, currency, convert_company)
         sequence_per_invoice_type = self._get_profitability_sequence_per_invoice_type()
+        revenues_dict = {}
+        total_to_invoice = total_invoiced = 0.0
+        data = []
+        if downpayment_amount_invoiced:
+            data.append({
+                'id': 'downpayments',
+                'sequence': sequence_per_invoice_type['downpayments'],
+                'invoiced': downpayment_amount_invoiced,
+                'to_invoice': -downpayment_amount_invoiced,
+            })
+            total_invoiced += downpayment_amount_invoiced
+            total_to_invoice -= downpayment_amount_invoiced
+        for product_id in sorted(
+                (product_id for product_id in sols_per_product if product_id in group_and_invoice_type_per_product),
+                key=group_and_invoice_type_per_product.__getitem__):
+            amount_to_invoice, amount_invoiced = sols_per_product[product_id]
+            invoice_type = group_and_invoice_type_per_product[product_id][1]
+            revenue = revenues_dict.setdefault(invoice_type, {'invoiced': 0.0, 'to_invoice': 0.0})
+            revenue['to_invoice'] += amount_to_invoice
+            total_to_invoice += amount_to_invoice
+            revenue['invoiced'] += amount_invoiced
+            total_invoiced += amount_invoiced
         data += [{
             'id': invoice_type,
             'sequence': sequence_per_invoice_type[invoice_type],
@@ -151,22 +387,237 @@ class Project(models.Model):
             'total': {'to_invoice': total_to_invoice, 'invoiced': total_invoiced},
         }
 
+    @api.model
+    def _get_profitability_snapshot_max_age(self):
+        """ Hours after which a snapshot is no longer trusted, even though its deltas were all applied """
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'project.profitability_snapshot_max_age_hours', 72))
+
+    def _filter_fresh_profitability_snapshot(self):
+        """ Return the projects whose snapshot can be read: built, and not older than the maximum age """
+        oldest_date = fields.Datetime.now() - timedelta(hours=self._get_profitability_snapshot_max_age())
+        return self.filtered(lambda project:
+            project.profitability_snapshot_date and project.profitability_snapshot_date >= oldest_date)
+
+    def _get_revenues_items_from_snapshot(self):
+        # apply the pending changes of the transaction first
+        self.env['sale.order.line'].flush_model()
+        if self.env.cr.precommit.data.get('project.profitability_snapshot_sync'):
+            self._sync_profitability_snapshot_pending_sale_items()
+        snapshots = self.env['project.profitability.snapshot'].sudo().search_fetch(
+            [('project_id', 'in', self.ids)],
+            ['project_id', 'currency_id', 'product_id', 'is_downpayment', 'to_invoice', 'invoiced', 'line_count'],
+        )
+        amounts_per_project = defaultdict(dict)
+        for snapshot in snapshots:
+            amounts_per_project[snapshot.project_id.id][snapshot.currency_id.id, snapshot.product_id.id, snapshot.is_downpayment] = \
+                [snapshot.to_invoice, snapshot.invoiced, snapshot.line_count]
+        group_and_invoice_type_per_product = self._get_profitability_invoice_type_per_product(
+            snapshots.filtered(lambda snapshot: not snapshot.is_downpayment).product_id.ids)
+        return {
+            project.id: project._get_revenues_items_from_sale_line_amounts(
+                amounts_per_project.get(project.id, {}), group_and_invoice_type_per_product)
+            for project in self
+        }
+
+    def _rebuild_profitability_snapshot(self):
+        """ Replace the profitability snapshot of the projects by the live computation """
+        amounts_per_project, sale_items_per_project = self._get_profitability_sale_line_amounts_per_project()
+        Snapshot = self.env['project.profitability.snapshot'].sudo()
+        Snapshot.search([('project_id', 'in', self.ids)]).unlink()
+        Snapshot.create([{
+            'project_id': project_id,
+            'currency_id': currency_id,
+            'product_id': product_id,
+            'is_downpayment': is_downpayment,
+            'to_invoice': to_invoice,
+            'invoiced': invoiced,
+            'line_count': line_count,
+        } for project_id, amounts_per_key in amounts_per_project.items()
+          for (currency_id, product_id, is_downpayment), (to_invoice, invoiced, line_count) in amounts_per_key.items()])
+        now = fields.Datetime.now()
+        for project in self.sudo():
+            sale_items = sale_items_per_project.get(project.id, self.env['sale.order.line'])
+            project.write({
+                'profitability_snapshot_date': now,
+                'profitability_snapshot_sale_line_ids': [Command.set(sale_items.ids)],
+            })
+        # read from the database by the hooks of the sale order items, which run while they are flushed
+        self.sudo().flush_recordset(['profitability_snapshot_date', 'profitability_snapshot_sale_line_ids'])
+        Snapshot.flush_model()
+
+    def action_rebuild_profitability_snapshot(self):
+        self._rebuild_profitability_snapshot()
+
+    def _sync_profitability_snapshot_sale_items_later(self):
+        """ Follow the changes of the sale order items of the projects in their snapshots at the end of the
+            transaction, once for all the projects whose tasks, milestones, employee mappings, ... changed.
+        """
+        project_ids = self.sudo().filtered('profitability_snapshot_date').ids
+        if not project_ids:
+            return
+        pending_project_ids = self.env.cr.precommit.data.setdefault('project.profitability_snapshot_sync', set())
+        if not pending_project_ids:
+            self.env.cr.precommit.add(self.sudo().browse()._sync_profitability_snapshot_pending_sale_items)
+        pending_project_ids.update(project_ids)
+
+    def _sync_profitability_snapshot_pending_sale_items(self):
+        project_ids = self.env.cr.precommit.data.pop('project.profitability_snapshot_sync', set())
+        self.browse(project_ids).exists()._sync_profitability_snapshot_sale_items()
+
+    def _sync_profitability_snapshot_sale_items(self):
+        """ Update the snapshots of the projects with the sale order items which started or stopped counting
+            for them since their sale items changed: the items of the sales orders they started or stopped
+            selling, and the sale items of other projects they started or stopped selling.
+        """
+        projects = self.sudo().filtered('profitability_snapshot_date')
+        if not projects:
+            return
+        self.env.flush_all()
+        sale_items_per_project = projects._fetch_sale_order_items_per_project_id()
+        Snapshot = self.env['project.profitability.snapshot'].sudo()
+        amounts_per_key = defaultdict(lambda: [0.0, 0.0, 0])
+        for project in projects:
+            old_sale_items = project.profitability_snapshot_sale_line_ids
+            new_sale_items = sale_items_per_project.get(project.id, self.env['sale.order.line'])
+            if old_sale_items == new_sale_items:
+                continue
+            old_order_ids, new_order_ids = set(old_sale_items.order_id.ids), set(new_sale_items.order_id.ids)
+            old_item_ids, new_item_ids = set(old_sale_items.ids), set(new_sale_items.ids)
+            rows = Snapshot._read_sale_line_rows(old_item_ids ^ new_item_ids, old_order_ids ^ new_order_ids)
+            for row in rows:
+                if not Snapshot._is_counted_sale_line_row(row):
+                    continue
+                sign = Snapshot._is_project_sale_line_row(row, project.id, new_order_ids, new_item_ids) \
+                    - Snapshot._is_project_sale_line_row(row, project.id, old_order_ids, old_item_ids)
+                if sign:
+                    Snapshot._add_sale_line_row(amounts_per_key, project.id, row, sign)
+            project.profitability_snapshot_sale_line_ids = [Command.set(new_sale_items.ids)]
+        Snapshot._add_amounts(amounts_per_key)
+        projects.flush_recordset(['profitability_snapshot_sale_line_ids'])
+
+    @api.model
+    def _cron_rebuild_profitability_snapshots(self, batch_size=100):
+        """ Rebuild the missing and invalidated snapshots of the billable projects, batch after batch, and
+            the snapshots past half their maximum age, so that a snapshot never expires between two runs.
+        """
+        oldest_date = fields.Datetime.now() - timedelta(hours=self._get_profitability_snapshot_max_age() / 2)
+        projects = self.sudo().search([
+            ('allow_billable', '=', True),
+            '|', ('profitability_snapshot_date', '=', False), ('profitability_snapshot_date', '<', oldest_date),
+        ])
+        for index in range(0, len(projects), batch_size):
+            projects[index:index + batch_size]._rebuild_profitability_snapshot()
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'sale_line_id' in vals:
+            self._sync_profitability_snapshot_sale_items_later()
+        return res
+
     class ProjectTask(models.Model):
         _inherit = "project.task"
 
+        @api.model_create_multi
+        def create(self, vals_list):
+            tasks = super().create(vals_list)
+            tasks.filtered('sale_line_id').project_id._sync_profitability_snapshot_sale_items_later()
+            return tasks
+
+        def write(self, vals):
+            if 'sale_line_id' not in vals and 'project_id' not in vals:
+                return super().write(vals)
+            projects = self.project_id
+            res = super().write(vals)
+            (projects | self.project_id)._sync_profitability_snapshot_sale_items_later()
+            return res
+
+        def unlink(self):
+            projects = self.filtered('sale_line_id').project_id
+            res = super().unlink()
+            projects._sync_profitability_snapshot_sale_items_later()
+            return res
+
+        def _compute_sale_line(self):
+            # sale_timesheet falls back on _get_last_sol_of_customer task by task: resolve it for the whole batch
+            # beforehand, with one search per (company, commercial partner, sales order), for the tasks sale_project
+            # cannot give the SOL of their parent, project or milestone. The others are left to the fallback.
+            tasks = self.filtered(lambda task:
+                task.allow_billable
+                and not task.sale_line_id
+                and not task.project_id.sale_line_id
+                and not task.parent_id.sale_line_id
+                and not task.display_project_id.sale_line_id
+                and not task.milestone_id.sale_line_id
+            )
+            sol_id_per_task = {
+                task_id: sol.id if sol else False
+                for task_id, sol in tasks._get_last_sol_of_customer_per_task().items()
+            }
+            super(ProjectTask, self.with_context(last_sol_id_per_task=sol_id_per_task))._compute_sale_line()
+
         def _get_last_sol_of_customer(self):
             # Get the last SOL made for the customer in the current task where we need to compute
             self.ensure_one()
-            if not self.partner_id.commercial_partner_id or not self.allow_billable:
-                return False
-            domain = [
-                ('company_id', '=?', self.company_id.id),
-                ('order_partner_id', 'child_of', self.partner_id.commercial_partner_id.ids),
-                ('is_expense', '=', False),
-                ('state', '=', 'sale'),
-                ('remaining_hours', '>', 0),
-            ]
-            if self.project_id.pricing_type != 'task_rate' and self.project_sale_order_id and self.partner_id.commercial_partner_id == self.project_id.partner_id.commercial_partner_id:
-                domain.append(('order_id', '=?', self.project_sale_order_id.id))
-            return self.env['sale.order.line'].search(domain, limit=1)
+            sol_id_per_task = self.env.context.get('last_sol_id_per_task') or {}
+            if self.id in sol_id_per_task:
+                return self.env['sale.order.line'].browse(sol_id_per_task[self.id])
+            return self._get_last_sol_of_customer_per_task()[self.id]
+
+        def _get_last_sol_of_customer_per_task(self):
+            """ Recordset version of :meth:`_get_last_sol_of_customer`: the tasks sharing the same company,
+                commercial partner and project sales order are resolved with a single search.
+
+                :returns: a dict with the task id as key and its SOL, or False, as value
+            """
+            sol_per_task = {}
+            task_ids_per_key = defaultdict(list)
+            for task in self:
+                commercial_partner = task.partner_id.commercial_partner_id
+                if not commercial_partner or not task.allow_billable:
+                    sol_per_task[task.id] = False
+                    continue
+                sale_order = self.env['sale.order']
+                if task.project_id.pricing_type != 'task_rate' and task.project_sale_order_id and commercial_partner == task.project_id.partner_id.commercial_partner_id:
+                    sale_order = task.project_sale_order_id
+                task_ids_per_key[task.company_id, commercial_partner, sale_order].append(task.id)
+            for (company, commercial_partner, sale_order), task_ids in task_ids_per_key.items():
+                domain = [
+                    ('company_id', '=?', company.id),
+                    ('order_partner_id', 'child_of', commercial_partner.ids),
+                    ('is_expense', '=', False),
+                    ('state', '=', 'sale'),
+                    ('remaining_hours', '>', 0),
+                ]
+                if sale_order:
+                    domain.append(('order_id', '=?', sale_order.id))
+                sol = self.env['sale.order.line'].search(domain, limit=1)
+                for task_id in task_ids:
+                    sol_per_task[task_id] = sol
+            return sol_per_task
+
+
+class ProjectMilestone(models.Model):
+    _inherit = "project.milestone"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        milestones = super().create(vals_list)
+        milestones.filtered('sale_line_id').project_id._sync_profitability_snapshot_sale_items_later()
+        return milestones
+
+    def write(self, vals):
+        if 'sale_line_id' not in vals and 'project_id' not in vals:
+            return super().write(vals)
+        projects = self.project_id
+        res = super().write(vals)
+        (projects | self.project_id)._sync_profitability_snapshot_sale_items_later()
+        return res
 
+    def unlink(self):
+        projects = self.filtered('sale_line_id').project_id
+        res = super().unlink()
+        projects._sync_profitability_snapshot_sale_items_later()
+        return res
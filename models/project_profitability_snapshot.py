@@ -0,0 +1,166 @@
+from collections import defaultdict
+
+from odoo import api, fields, models
+
+# sale order item columns the snapshot is derived from
+SNAPSHOT_SALE_LINE_FIELDS = frozenset([
+    'untaxed_amount_to_invoice', 'untaxed_amount_invoiced', 'qty_to_invoice', 'qty_invoiced',
+    'product_id', 'project_id', 'order_id', 'currency_id', 'is_downpayment', 'is_expense', 'state',
+])
+
+
+class ProjectProfitabilitySnapshot(models.Model):
+    """ Amounts of the sale order items of a project, as counted by its profitability panel
+
+        The amounts are kept in the currency of the sale order items and summed per currency, product
+        and down payment flag, the keys of the panel computation: they are converted and classified into
+        revenue sections when read, so that the snapshot gives the same result as the live computation,
+        sections of zero amount included.
+    """
+    _name = 'project.profitability.snapshot'
+    _description = 'Project Profitability Snapshot'
+    _order = 'project_id, id'
+
+    project_id = fields.Many2one('project.project', required=True, index=True, ondelete='cascade')
+    currency_id = fields.Many2one('res.currency', required=True, ondelete='cascade')
+    product_id = fields.Many2one('product.product', required=True, ondelete='cascade')
+    is_downpayment = fields.Boolean()
+    to_invoice = fields.Monetary()
+    invoiced = fields.Monetary()
+    line_count = fields.Integer()
+
+    _sql_constraints = [
+        ('project_currency_product_uniq', 'unique(project_id, currency_id, product_id, is_downpayment)',
+         'A project can only have one snapshot per currency, product and down payment flag.'),
+    ]
+
+    @api.model
+    def _has_snapshots(self):
+        """ Return whether a project keeps its profitability snapshot up to date
+
+            Read straight from the database, as it is called while the sale order items are flushed: the
+            snapshot dates are flushed as soon as they are written, by :meth:`project.project._rebuild_profitability_snapshot`.
+        """
+        self.env.cr.execute("SELECT 1 FROM project_project WHERE profitability_snapshot_date IS NOT NULL LIMIT 1")
+        return bool(self.env.cr.rowcount)
+
+    @api.model
+    def _read_sale_line_rows(self, sale_line_ids, order_ids=()):
+        """ Read, straight from the database, the values of the sale order items the snapshot depends on
+
+            :param sale_line_ids: the ids of the sale order items to read
+            :param order_ids: the ids of the sales orders whose items are read as well
+        """
+        if not sale_line_ids and not order_ids:
+            return []
+        self.env.cr.execute("""
+            SELECT id, order_id, project_id, untaxed_amount_to_invoice, untaxed_amount_invoiced,
+                   qty_to_invoice, qty_invoiced, product_id, currency_id, is_downpayment, is_expense, state
+              FROM sale_order_line
+             WHERE id IN %s OR order_id IN %s
+        """, [tuple(sale_line_ids) or (None,), tuple(order_ids) or (None,)])
+        return self.env.cr.dictfetchall()
+
+    @api.model
+    def _get_sale_items_of_orders(self, order_ids):
+        """ Return the sale order items of the snapshots kept up to date that belong to the given sales orders
+
+            The sale items of the snapshots are flushed whenever they are written, and the sales order of an
+            item never changes: the database is read as it is, without flushing while the items are flushed.
+
+            :returns: a dict with the project id as key and, as value, a tuple with the ids of the sales
+                orders and of the sale order items of the project, limited to ``order_ids``
+        """
+        if not order_ids:
+            return {}
+        self.env.cr.execute("""
+            SELECT rel.project_id, sol.order_id, sol.id
+              FROM project_profitability_snapshot_sale_line_rel rel
+              JOIN project_project project ON project.id = rel.project_id
+              JOIN sale_order_line sol ON sol.id = rel.sale_line_id
+             WHERE project.profitability_snapshot_date IS NOT NULL
+               AND sol.order_id IN %s
+        """, [tuple(order_ids)])
+        sale_items_per_project = defaultdict(lambda: (set(), set()))
+        for project_id, order_id, sale_line_id in self.env.cr.fetchall():
+            sale_items_per_project[project_id][0].add(order_id)
+            sale_items_per_project[project_id][1].add(sale_line_id)
+        return sale_items_per_project
+
+    @api.model
+    def _apply_sale_line_changes(self, old_rows, new_rows):
+        """ Update the snapshots by the difference between the contributions of the sale order items
+            before (``old_rows``) and after (``new_rows``) a change, as read by :meth:`_read_sale_line_rows`.
+        """
+        rows = [(-1, row) for row in old_rows if self._is_counted_sale_line_row(row)] \
+            + [(1, row) for row in new_rows if self._is_counted_sale_line_row(row)]
+        if not rows:
+            return
+        sale_items_per_project = self._get_sale_items_of_orders({row['order_id'] for sign, row in rows})
+        amounts_per_key = defaultdict(lambda: [0.0, 0.0, 0])
+        for project_id, (order_ids, sale_line_ids) in sale_items_per_project.items():
+            for sign, row in rows:
+                if self._is_project_sale_line_row(row, project_id, order_ids, sale_line_ids):
+                    self._add_sale_line_row(amounts_per_key, project_id, row, sign)
+        self._add_amounts(amounts_per_key)
+
+    @api.model
+    def _is_counted_sale_line_row(self, row):
+        # same filter as project.project._get_profitability_sale_order_items_domain
+        return row['product_id'] and not row['is_expense'] and row['state'] == 'sale' \
+            and ((row['qty_to_invoice'] or 0.0) > 0 or (row['qty_invoiced'] or 0.0) > 0)
+
+    @api.model
+    def _is_project_sale_line_row(self, row, project_id, order_ids, sale_line_ids):
+        # same rule as the profitability panel of sale_project: the items of the sales orders of the sale
+        # items of the project which belong to the project or to no project, and the sale items themselves
+        return row['order_id'] in order_ids \
+            and (not row['project_id'] or row['project_id'] == project_id or row['id'] in sale_line_ids)
+
+    @api.model
+    def _add_sale_line_row(self, amounts_per_key, project_id, row, sign):
+        amounts = amounts_per_key[project_id, row['currency_id'], row['product_id'], bool(row['is_downpayment'])]
+        amounts[0] += sign * (row['untaxed_amount_to_invoice'] or 0.0)
+        amounts[1] += sign * (row['untaxed_amount_invoiced'] or 0.0)
+        amounts[2] += sign
+
+    @api.model
+    def _add_amounts(self, amounts_per_key):
+        """ Add amounts to the snapshots, creating the missing ones and removing those left without items
+
+            :param amounts_per_key: a dict with a (project id, currency id, product id, is downpayment) tuple
+                as key and the amounts to add, as a [to_invoice, invoiced, line_count] list, as value
+        """
+        amounts_per_key = {key: amounts for key, amounts in amounts_per_key.items() if any(amounts)}
+        if not amounts_per_key:
+            return
+        for (project_id, currency_id, product_id, is_downpayment), (to_invoice, invoiced, line_count) in amounts_per_key.items():
+            self.env.cr.execute("""
+                INSERT INTO project_profitability_snapshot
+                            (project_id, currency_id, product_id, is_downpayment, to_invoice, invoiced, line_count,
+                             create_uid, create_date, write_uid, write_date)
+                     VALUES (%(project_id)s, %(currency_id)s, %(product_id)s, %(is_downpayment)s,
+                             %(to_invoice)s, %(invoiced)s, %(line_count)s,
+                             %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC')
+                ON CONFLICT (project_id, currency_id, product_id, is_downpayment) DO UPDATE
+                        SET to_invoice = project_profitability_snapshot.to_invoice + EXCLUDED.to_invoice,
+                            invoiced = project_profitability_snapshot.invoiced + EXCLUDED.invoiced,
+                            line_count = project_profitability_snapshot.line_count + EXCLUDED.line_count,
+                            write_uid = EXCLUDED.write_uid,
+                            write_date = EXCLUDED.write_date
+            """, {
+                'project_id': project_id,
+                'currency_id': currency_id,
+                'product_id': product_id,
+                'is_downpayment': is_downpayment,
+                'to_invoice': to_invoice,
+                'invoiced': invoiced,
+                'line_count': line_count,
+                'uid': self.env.uid,
+            })
+        self.env.cr.execute("""
+            DELETE FROM project_profitability_snapshot
+                  WHERE line_count <= 0
+                    AND project_id IN %s
+        """, [tuple({project_id for project_id, __, __, __ in amounts_per_key})])
+        self.invalidate_model(['to_invoice', 'invoiced', 'line_count'])
@@ -1,4 +1,4 @@
-from odoo import models
+from odoo import api, models
 from odoo.osv import expression
 from odoo.tools.misc import unquote
 
@@ -15,4 +15,24 @@ class ProjectProductEmployeeMap(models.Model):
                 ('order_partner_id', '=?', unquote('partner_id')),
             ],
         ])
-        return domain
\ No newline at end of file
+        return domain
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        mappings = super().create(vals_list)
+        mappings.filtered('sale_line_id').project_id._sync_profitability_snapshot_sale_items_later()
+        return mappings
+
+    def write(self, vals):
+        if 'sale_line_id' not in vals and 'project_id' not in vals:
+            return super().write(vals)
+        projects = self.project_id
+        res = super().write(vals)
+        (projects | self.project_id)._sync_profitability_snapshot_sale_items_later()
+        return res
+
+    def unlink(self):
+        projects = self.filtered('sale_line_id').project_id
+        res = super().unlink()
+        projects._sync_profitability_snapshot_sale_items_later()
+        return res
\ No newline at end of file
@@ -5,17 +5,17 @@ class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
 
     def set_values(self):
+        milestone_group = self.env.ref('project.group_project_milestone')
+        milestones_were_enabled = milestone_group in self.env.ref('base.group_user').implied_ids
         super().set_values()
         if self.group_project_milestone:
+            self.env['storable.service.job']._cancel_jobs('milestones_disabled')
             # Search the milestones containing a SOL and change the qty_delivered_method field of the SOL and the
             # service_policy field set on the product to convert from manual to milestones.
             milestones = self.env['project.milestone'].search_fetch([('sale_line_id', '!=', False)], ['sale_line_id'])
             sale_lines = milestones.sale_line_id.sudo()
             sale_lines.product_id.service_policy = 'delivered_milestones'
-        else:
-            product_domain = [
-                ('type', 'in', ['service', 'product']),]
-                # ('service_type', '=', 'milestones')]
-            products = self.env['product.product'].search(product_domain)
-            products.service_policy = 'delivered_manual'
-            self.env['sale.order.line'].sudo().search([('product_id', 'in', products.ids)]).qty_delivered_method = 'manual'
\ No newline at end of file
+        elif milestones_were_enabled:
+            # switching every service and storable product, and their SOLs, to manual delivery can touch
+            # hundreds of thousands of rows: it is done in chunks by a background job
+            self.env['storable.service.job']._enqueue_milestones_disabled()
@@ -1,44 +1,82 @@
 from odoo import api, models,fields, _
 from odoo.exceptions import UserError
 import ast
+from collections import defaultdict
 from odoo.osv.expression import AND
-from odoo.tools import float_compare
+from odoo.tools import split_every
+
+VALID_SERVICE_ORDER_CHUNK_SIZE = 10000
 
 
 
 class SaleOrder(models.Model):
     _inherit = 'sale.order'
 
-    def _compute_show_project_and_task_button(self):
-        is_project_manager = self.env.user.has_group('project.group_project_manager')
+    service_generation_state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string="Project/Task Generation", compute='_compute_service_generation_state')
 
-        # Use the public read_group method (not _read_group)
-        grouped_data = self.env['sale.order.line'].read_group(
-            domain=[
-                ('order_id', 'in', self.ids),
-                ('order_id.state', 'not in', ['draft', 'sent']),
-                ('product_id.detailed_type', 'in', ['service', 'product']),
-            ],
-            fields=['order_id'],
-            groupby=['order_id']
-        )
+    @api.depends('order_line.service_generation_state')
+    def _compute_service_generation_state(self):
+        for order in self:
+            states = set(order.order_line.mapped('service_generation_state'))
+            order.service_generation_state = next((state for state in ['failed', 'pending', 'done'] if state in states), False)
 
-        show_button_ids = {data['order_id'][0] for data in grouped_data if data['order_id']}
+    def action_retry_service_generation(self):
+        failed_lines = self.order_line.filtered(lambda line: line.service_generation_state == 'failed')
+        if failed_lines:
+            failed_lines.service_generation_state = 'pending'
+            failed_lines._get_service_generation_cron()._trigger()
 
+    def _compute_show_project_and_task_button(self):
+        is_project_manager = self.env.user.has_group('project.group_project_manager')
+        show_button_ids, eligible_order_ids = self._get_project_and_task_button_order_ids()
         for order in self:
             order.show_project_button = order.id in show_button_ids and bool(order.project_count)
             order.show_task_button = order.show_project_button or bool(order.tasks_count)
-
-            eligible_templates = order.order_line.mapped('product_template_id').filtered(
-                lambda x: x.service_policy in ['delivered_timesheet', 'delivered_milestones']
-            )
             order.show_create_project_button = (
                     is_project_manager and
                     order.id in show_button_ids and
                     not order.project_count and
-                    bool(eligible_templates)
+                    order.id in eligible_order_ids
             )
 
+    def _get_project_and_task_button_order_ids(self):
+        """ Find, in one grouped query and without loading the order lines, the orders that
+
+            - are confirmed and sell a service or a storable product,
+            - sell a product invoiced on timesheets or milestones, whatever their state.
+
+            :returns: a tuple with the set of ids of each kind of orders
+        """
+        order_ids = tuple(order_id for order_id in self.ids if order_id)
+        if not order_ids:
+            return set(), set()
+        self.flush_model(['state'])
+        self.env['sale.order.line'].flush_model(['order_id', 'product_id', 'product_service_policy'])
+        self.env['product.product'].flush_model(['product_tmpl_id'])
+        self.env['product.template'].flush_model(['detailed_type'])
+        self.env.cr.execute("""
+            SELECT sol.order_id,
+                   BOOL_OR(so.state NOT IN ('draft', 'sent') AND pt.detailed_type IN ('service', 'product')),
+                   BOOL_OR(sol.product_service_policy IN ('delivered_timesheet', 'delivered_milestones'))
+              FROM sale_order_line sol
+              JOIN sale_order so ON so.id = sol.order_id
+              JOIN product_product pp ON pp.id = sol.product_id
+              JOIN product_template pt ON pt.id = pp.product_tmpl_id
+             WHERE sol.order_id IN %s
+          GROUP BY sol.order_id
+        """, [order_ids])
+        show_button_ids = set()
+        eligible_order_ids = set()
+        for order_id, show_button, has_eligible_template in self.env.cr.fetchall():
+            if show_button:
+                show_button_ids.add(order_id)
+            if has_eligible_template:
+                eligible_order_ids.add(order_id)
+        return show_button_ids, eligible_order_ids
 
     def action_view_task(self):
         self.ensure_one()
@@ -122,18 +160,56 @@ class SaleOrder(models.Model):
             action.update({'views': [(False, 'form')], 'res_id': self.project_ids.id})
         return action
 
+    def write(self, vals):
+        if 'project_id' not in vals:
+            return super().write(vals)
+        # the project of a sales order can change the sale order items of the project
+        projects = self.project_id
+        res = super().write(vals)
+        (projects | self.project_id)._sync_profitability_snapshot_sale_items_later()
+        return res
+
     def _get_order_with_valid_service_product(self):
         # Modified to include all product types
-        groups = self.env['sale.order.line'].read_group(
-            domain=[
-                ('order_id', 'in', self.ids),
-                ('order_id.state', '=', 'sale'),
-                ('product_id.type', 'in', ['service', 'product']),
-            ],
-            fields=['order_id'],
-            groupby=['order_id']
+        return self.search(self._get_order_with_valid_service_product_domain(self.ids)).ids
+
+    def _iter_order_with_valid_service_product(self, chunk_size=VALID_SERVICE_ORDER_CHUNK_SIZE):
+        """ Same as `_get_order_with_valid_service_product`, as a generator working on chunks of ``chunk_size``
+            orders, for the callers handling very large recordsets. Within a chunk the ids come in the
+            default order of the model.
+        """
+        for order_ids in split_every(chunk_size, self.ids):
+            yield from self.search(self._get_order_with_valid_service_product_domain(order_ids)).ids
+
+    @api.model
+    def _get_order_with_valid_service_product_domain(self, order_ids):
+        # the lines are only checked for existence, without grouping them
+        return [
+            ('id', 'in', order_ids),
+            ('state', '=', 'sale'),
+            ('order_line', 'any', [('is_service', '=', True)]),
+        ]
+
+    def _compute_field_value(self, field):
+        if field.name != 'invoice_status' or self.env.context.get('mail_activity_automation_skip'):
+            return super()._compute_field_value(field)
+        # as sale_project does, but with the lines to upsell of all the orders read in one query
+        upsellable_orders = self.filtered(lambda so:
+            so.state == 'sale'
+            and so.invoice_status != 'upselling'
+            and so.id
+            and (so.user_id or so.partner_id.user_id)
         )
-        return [g['order_id'][0] for g in groups]
+        super(SaleOrder, upsellable_orders.with_context(mail_activity_automation_skip=True))._compute_field_value(field)
+        upsellable_lines_per_order = upsellable_orders._get_prepaid_service_lines_to_upsell_per_order()
+        for order in upsellable_orders:
+            upsellable_lines = upsellable_lines_per_order.get(order)
+            if upsellable_lines:
+                order._create_upsell_activity()
+                # We want to display only one time the warning for each SOL
+                upsellable_lines.write({'has_displayed_warning_upsell': True})
+        # the other orders are left to sale_project, which finds none of them upsellable
+        super(SaleOrder, self - upsellable_orders)._compute_field_value(field)
 
     def _get_prepaid_service_lines_to_upsell(self):
         """ Retrieve all sols which need to display an upsell activity warning in the SO
@@ -141,18 +217,47 @@ class SaleOrder(models.Model):
             Modified to include all product types with ordered_prepaid policy
         """
         self.ensure_one()
+        return self._get_prepaid_service_lines_to_upsell_per_order().get(self, self.env['sale.order.line'])
+
+    def _get_prepaid_service_lines_to_upsell_per_order(self):
+        """ Same as `_get_prepaid_service_lines_to_upsell` for many orders at once, in a single query
+
+            :returns: a dict with the order as key and its sols to upsell as value, only for the orders
+                having some
+        """
+        order_ids = tuple(order_id for order_id in self.ids if order_id)
+        if not order_ids:
+            return {}
         precision = self.env['decimal.precision'].precision_get('Product Unit of Measure')
-        return self.order_line.filtered(lambda sol:
-                                        sol.product_id.type in ['service', 'product']
-                                        and sol.invoice_status != "invoiced"
-                                        and not sol.has_displayed_warning_upsell
-                                        and sol.product_id.service_policy == 'ordered_prepaid'
-                                        and float_compare(
-                                            sol.qty_delivered,
-                                            sol.product_uom_qty * (sol.product_id.service_upsell_threshold or 1.0),
-                                            precision_digits=precision
-                                        ) > 0
-                                        )
+        self.env['sale.order.line'].flush_model([
+            'order_id', 'product_id', 'is_service', 'product_service_policy', 'invoice_status',
+            'has_displayed_warning_upsell', 'qty_delivered', 'product_uom_qty', 'sequence',
+        ])
+        self.env['product.product'].flush_model(['product_tmpl_id'])
+        self.env['product.template'].flush_model(['service_upsell_threshold'])
+        self.env.cr.execute("""
+            SELECT sol.order_id, sol.id
+              FROM sale_order_line sol
+              JOIN product_product pp ON pp.id = sol.product_id
+              JOIN product_template pt ON pt.id = pp.product_tmpl_id
+             WHERE sol.order_id IN %(order_ids)s
+               AND sol.is_service
+               AND sol.product_service_policy = 'ordered_prepaid'
+               AND sol.invoice_status IS DISTINCT FROM 'invoiced'
+               AND sol.has_displayed_warning_upsell IS NOT TRUE
+               -- as float_compare: both sides are rounded before being compared
+               AND ROUND(COALESCE(sol.qty_delivered, 0)::numeric, %(precision)s)
+                   > ROUND((COALESCE(sol.product_uom_qty, 0)
+                            * COALESCE(NULLIF(pt.service_upsell_threshold, 0), 1.0))::numeric, %(precision)s)
+          ORDER BY sol.order_id, sol.sequence, sol.id
+        """, {'order_ids': order_ids, 'precision': precision})
+        line_ids_per_order_id = defaultdict(list)
+        for order_id, line_id in self.env.cr.fetchall():
+            line_ids_per_order_id[order_id].append(line_id)
+        return {
+            self.browse(order_id): self.env['sale.order.line'].browse(line_ids)
+            for order_id, line_ids in line_ids_per_order_id.items()
+        }
 
     @api.model_create_multi
     def create(self, vals_list):
@@ -1,7 +1,68 @@
-from odoo import api, fields, models, _
+import json
+import logging
+import time
+from collections import defaultdict
+
+from odoo import api, fields, models, Command, _
 from odoo.osv import expression
-from odoo.tools.sql import column_exists, create_column
+from odoo.tools import SQL, split_every
+from odoo.tools.sql import column_exists, create_column, create_index, drop_index
+
+from .project_profitability_snapshot import SNAPSHOT_SALE_LINE_FIELDS
+from .utils import update_by_id_ranges
+
+_logger = logging.getLogger(__name__)
+
+IS_SERVICE_BACKFILL_QUERY = """
+    UPDATE sale_order_line line
+       SET is_service = pt.type IN ('service', 'product')
+      FROM product_product pp
+      JOIN product_template pt ON pt.id = pp.product_tmpl_id
+     WHERE pp.id = line.product_id
+       AND line.id >= %(id_from)s AND line.id < %(id_to)s
+       AND line.is_service IS DISTINCT FROM (pt.type IN ('service', 'product'))
+"""
+
+# Lines of expense products are already 'analytic', every other delivered method is left to sale and sale_stock.
+QTY_DELIVERED_METHOD_BACKFILL_QUERY = """
+    UPDATE sale_order_line line
+       SET qty_delivered_method = pt.service_type
+      FROM product_product pp
+      JOIN product_template pt ON pt.id = pp.product_tmpl_id
+     WHERE pp.id = line.product_id
+       AND line.id >= %(id_from)s AND line.id < %(id_to)s
+       AND line.is_expense IS NOT TRUE
+       AND pt.type IN ('service', 'product')
+       AND pt.service_type IN ('timesheet', 'milestones')
+       AND line.qty_delivered_method IS DISTINCT FROM pt.service_type
+"""
+
+# product attributes copied on the lines, see _auto_init
+PRODUCT_SERVICE_COLUMNS = ('product_service_type', 'product_service_tracking', 'product_service_policy')
+# service_policy is not stored on products: it is resolved from the general to service map given as
+# json (keyed by "invoice_policy,service_type"), falling back to prepaid as in _compute_service_policy
+PRODUCT_SERVICE_FIELDS_BACKFILL_QUERY = """
+    UPDATE sale_order_line line
+       SET product_service_type = p.service_type,
+           product_service_tracking = p.service_tracking,
+           product_service_policy = p.service_policy
+      FROM (
+            SELECT pp.id, pt.service_type, pt.service_tracking,
+                   COALESCE(
+                       %(service_policy_per_key)s::jsonb ->> (pt.invoice_policy || ',' || pt.service_type),
+                       CASE WHEN pt.type IN ('service', 'product') THEN 'ordered_prepaid' END
+                   ) AS service_policy
+              FROM product_product pp
+              JOIN product_template pt ON pt.id = pp.product_tmpl_id
+           ) p
+     WHERE p.id = line.product_id
+       AND line.id >= %(id_from)s AND line.id < %(id_to)s
+       AND (line.product_service_type, line.product_service_tracking, line.product_service_policy)
+           IS DISTINCT FROM (p.service_type, p.service_tracking, p.service_policy)
+"""
 
+# number of sale order items handled at once by _recompute_qty_to_invoice
+QTY_TO_INVOICE_CHUNK_SIZE = 1000
 
 
 class SaleOrderLine(models.Model):
@@ -9,6 +70,19 @@ class SaleOrderLine(models.Model):
 
     # used to know if generate a task and/or a project, depending on the product settings
     is_service = fields.Boolean("Is a Service", compute='_compute_is_service', store=True, compute_sudo=True)
+    # copied from the product, so that the lines can be filtered without joining the product tables
+    product_service_type = fields.Selection(
+        related='product_id.service_type', string="Product Service Type", store=True, index=True)
+    product_service_tracking = fields.Selection(
+        related='product_id.service_tracking', string="Product Service Tracking", store=True, index=True)
+    product_service_policy = fields.Selection(
+        related='product_id.service_policy', string="Product Service Policy", store=True, index=True)
+    service_generation_state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string="Project/Task Generation", copy=False, readonly=True, index='btree_not_null',
+        help="Set when the project and task of the line are generated in the background.")
 
     @api.depends('product_id.type')
     def _compute_is_service(self):
@@ -20,25 +94,107 @@ class SaleOrderLine(models.Model):
         Create column to stop ORM from computing it himself (too slow)
         """
         if not column_exists(self.env.cr, 'sale_order_line', 'is_service'):
+            # the column is filled range by range, with commits, by _backfill_storable_service_fields
+            # in the post-init hook and the migration: nothing is written while the module is loading
             create_column(self.env.cr, 'sale_order_line', 'is_service', 'bool')
-            self.env.cr.execute("""
-                    UPDATE sale_order_line line
-                    SET is_service = (pt.type in ['service','product'])
-                    FROM product_product pp
-                    LEFT JOIN product_template pt ON pt.id = pp.product_tmpl_id
-                    WHERE pp.id = line.product_id
-                """)
+        # same for the product attributes copied on the lines: the backfill, and its resumption when it
+        # was interrupted, are left to update_by_id_ranges
+        for column in PRODUCT_SERVICE_COLUMNS:
+            if not column_exists(self.env.cr, 'sale_order_line', column):
+                create_column(self.env.cr, 'sale_order_line', column, 'varchar')
         return super()._auto_init()
 
+    def _get_product_service_fields_backfill_params(self):
+        service_policy_per_key = {
+            '%s,%s' % key: service_policy
+            for key, service_policy in self.env['product.template']._get_general_to_service_map().items()
+        }
+        return {'service_policy_per_key': json.dumps(service_policy_per_key)}
+
+    def init(self):
+        super().init()
+        # partial indexes matching the confirmed-lines-of-a-customer domains used to pick a default SOL,
+        # with and without the remaining hours condition. The expense condition is written as the ORM
+        # translates ('is_expense', '=', False), for the planner to match it with the predicate.
+        drop_index(self.env.cr, 'sale_order_line_partner_remaining_hours_index', self._table)
+        create_index(
+            self.env.cr, 'sale_order_line_partner_remaining_hours_no_expense_index', self._table,
+            ['order_partner_id', 'company_id', 'order_id'],
+            where="state = 'sale' AND (is_expense IS NULL OR is_expense = FALSE) AND remaining_hours > 0",
+        )
+        create_index(
+            self.env.cr, 'sale_order_line_partner_confirmed_index', self._table,
+            ['order_partner_id', 'is_expense'],
+            where="state = 'sale'",
+        )
+
+    def _backfill_storable_service_fields(self):
+        """ Bring the stored fields of existing lines in line with the storable-as-service rules
+
+            Used on install and upgrade, where the ORM would otherwise leave the values computed by
+            sale_project and sale_timesheet (or recompute them line by line). The work is done with
+            set-based queries on id ranges, committed one range at a time.
+        """
+        self.env.flush_all()
+        update_by_id_ranges(self.env, 'sale_order_line', IS_SERVICE_BACKFILL_QUERY, 'sale_order_line.is_service')
+        update_by_id_ranges(
+            self.env, 'sale_order_line', QTY_DELIVERED_METHOD_BACKFILL_QUERY, 'sale_order_line.qty_delivered_method')
+        update_by_id_ranges(
+            self.env, 'sale_order_line', PRODUCT_SERVICE_FIELDS_BACKFILL_QUERY, 'sale_order_line.product_service_fields',
+            params=self._get_product_service_fields_backfill_params(),
+        )
+        self.invalidate_model(['is_service', 'qty_delivered_method', *PRODUCT_SERVICE_COLUMNS])
+
     @api.depends('is_expense', 'product_id.type', 'product_id.service_type')
     def _compute_qty_delivered_method(self):
+        """ Classify the whole batch at once: lines are grouped by (is_expense, product type, service type)
+            and each group is looked up once in the classification tables. Lines the tables do not cover
+            keep the method computed by the other sale modules.
+        """
+        self.product_id.fetch(['type', 'service_type'])
+        line_ids_per_key = defaultdict(list)
         for line in self:
-            if line.is_expense:
-                line.qty_delivered_method = 'analytic'
-            elif line.product_id and line.product_id.type in ['service','product'] and line.product_id.service_type == 'timesheet':
-                line.qty_delivered_method = 'timesheet'
+            key = (bool(line.is_expense), line.product_id.type, line.product_id.service_type)
+            line_ids_per_key[key].append(line.id)
+        classification = self.env['storable.service.classification']
+        other_line_ids = []
+        for key, line_ids in line_ids_per_key.items():
+            method = classification._get_qty_delivered_method(*key)
+            if method:
+                self.browse(line_ids).qty_delivered_method = method
             else:
-                line.qty_delivered_method = 'manual'
+                other_line_ids += line_ids
+        if other_line_ids:
+            super(SaleOrderLine, self.browse(other_line_ids))._compute_qty_delivered_method()
+
+    @api.model
+    def _get_last_sol_per_commercial_partner(self, commercial_partners):
+        """ Find, in one windowed query, the SOL each commercial partner would get from
+            ``search(domain, limit=1)``: the first of the confirmed non-expense lines with remaining hours
+            sold to the partner or to one of its contacts, in the default order of the model.
+
+            :returns: a dict with the commercial partner id as key and the SOL as value
+        """
+        if not commercial_partners:
+            return {}
+        sol_query = self._search([
+            ('order_partner_id', 'child_of', commercial_partners.ids),
+            ('is_expense', '=', False),
+            ('state', '=', 'sale'),
+            ('remaining_hours', '>', 0),
+        ])
+        # the ordering is the one of `_order`, the orders being sorted by their own `_order`
+        self.env.cr.execute(SQL("""
+            SELECT DISTINCT ON (cp.id) cp.id, sol.id
+              FROM res_partner cp
+              JOIN res_partner rp ON rp.parent_path LIKE cp.parent_path || %s
+              JOIN sale_order_line sol ON sol.order_partner_id = rp.id
+              JOIN sale_order so ON so.id = sol.order_id
+             WHERE cp.id IN %s
+               AND sol.id IN %s
+          ORDER BY cp.id, so.date_order DESC, so.id DESC, sol.sequence, sol.id
+        """, '%', tuple(commercial_partners.ids), sol_query.subselect()))
+        return {partner_id: self.browse(sol_id) for partner_id, sol_id in self.env.cr.fetchall()}
 
     def _get_product_from_sol_name_domain(self, product_name):
         return [
@@ -56,15 +212,33 @@ class SaleOrderLine(models.Model):
             if (line.product_id.type in ['service', 'product']) and line.state == 'sale':
                 line.product_updatable = False
 
-    @api.depends('product_id')
-    def _compute_qty_delivered_method(self):
-        milestones_lines = self.filtered(lambda sol:
-                                         not sol.is_expense
-                                         and (sol.product_id.type in ['service', 'product'])
-                                         and sol.product_id.service_type == 'milestones'
-                                         )
-        milestones_lines.qty_delivered_method = 'milestones'
-        super(SaleOrderLine, self - milestones_lines)._compute_qty_delivered_method()
+    def _write(self, vals):
+        Snapshot = self.env['project.profitability.snapshot'].sudo()
+        if not SNAPSHOT_SALE_LINE_FIELDS.intersection(vals) or not Snapshot._has_snapshots():
+            return super()._write(vals)
+        # keep the project profitability snapshots up to date with the difference
+        old_rows = Snapshot._read_sale_line_rows(self.ids)
+        res = super()._write(vals)
+        Snapshot._apply_sale_line_changes(old_rows, Snapshot._read_sale_line_rows(self.ids))
+        return res
+
+    @api.model
+    def _create(self, data_list):
+        lines = super()._create(data_list)
+        Snapshot = self.env['project.profitability.snapshot'].sudo()
+        if Snapshot._has_snapshots():
+            Snapshot._apply_sale_line_changes([], Snapshot._read_sale_line_rows(lines.ids))
+        return lines
+
+    def unlink(self):
+        Snapshot = self.env['project.profitability.snapshot'].sudo()
+        if not Snapshot._has_snapshots():
+            return super().unlink()
+        self.flush_recordset()
+        old_rows = Snapshot._read_sale_line_rows(self.ids)
+        res = super().unlink()
+        Snapshot._apply_sale_line_changes(old_rows, [])
+        return res
 
     def write(self, values):
         result = super().write(values)
@@ -72,10 +246,21 @@ class SaleOrderLine(models.Model):
         # task, whatever the SO state. It will be blocked by the super in case
         # of a locked sale order.
         if 'product_uom_qty' in values and not self.env.context.get('no_update_allocated_hours', False):
+            allocated_hours_per_task = {}
+            # the conversion only depends on the unit, the quantity and the company
+            allocated_hours_per_key = {}
             for line in self:
                 if line.task_id and (line.product_id.type in ['service', 'product']):
-                    allocated_hours = line._convert_qty_company_hours(line.task_id.company_id or self.env.user.company_id)
-                    line.task_id.write({'allocated_hours': allocated_hours})
+                    company = line.task_id.company_id or self.env.user.company_id
+                    key = (line.product_uom, line.product_uom_qty, company)
+                    if key not in allocated_hours_per_key:
+                        allocated_hours_per_key[key] = line._convert_qty_company_hours(company)
+                    allocated_hours_per_task[line.task_id] = allocated_hours_per_key[key]
+            task_ids_per_allocated_hours = defaultdict(list)
+            for task, allocated_hours in allocated_hours_per_task.items():
+                task_ids_per_allocated_hours[allocated_hours].append(task.id)
+            for allocated_hours, task_ids in task_ids_per_allocated_hours.items():
+                self.env['project.task'].browse(task_ids).write({'allocated_hours': allocated_hours})
         return result
 
     def _timesheet_create_project_prepare_values(self):
@@ -102,13 +287,11 @@ class SaleOrderLine(models.Model):
         }
 
     def _get_so_lines_task_global_project(self):
-        return self.filtered(lambda sol: sol.product_id.type in ['service',
-        'product'] and sol.product_id.service_tracking == 'task_global_project')
+        return self.filtered(lambda sol: sol.is_service and sol.product_service_tracking == 'task_global_project')
 
     def _get_so_lines_new_project(self):
         return self.filtered(
-            lambda sol: sol.product_id.type in ['service', 'product'] and sol.product_id.service_tracking in [
-                'project_only', 'task_in_project'])
+            lambda sol: sol.is_service and sol.product_service_tracking in ['project_only', 'task_in_project'])
 
 
     @api.model_create_multi
@@ -119,49 +302,238 @@ class SaleOrderLine(models.Model):
         lines = super().create(vals_list)
         if self.env.context.get('sale_no_log_for_new_lines'):
             return lines
+        product_names_per_order = defaultdict(list)
+        orders_without_account = self.env['sale.order']
         for line in lines:
             if line.product_id and line.state == 'sale':
-                msg = _("Extra line with %s", line.product_id.display_name)
-                line.order_id.message_post(body=msg)
+                product_names_per_order[line.order_id].append(line.product_id.display_name)
                 if (line.product_id.expense_policy not in [False, 'no'] or
                     (line.product_id.type in ['service', 'product'] and
                      line.product_id.service_type == 'timesheet')) and not line.order_id.analytic_account_id:
-                    line.order_id._create_analytic_account()
+                    orders_without_account |= line.order_id
+        # one analytic account per order, whatever the number of lines requiring it
+        orders_without_account.filtered(lambda order: not order.analytic_account_id)._create_analytic_account()
+        for order, product_names in product_names_per_order.items():
+            if len(product_names) == 1:
+                msg = _("Extra line with %s", product_names[0])
+            else:
+                msg = _("Extra lines with %s", ", ".join(product_names))
+            order.message_post(body=msg)
         return lines
 
-    @api.depends('product_id')
-    def _compute_qty_delivered_method(self):
-        """ Sale Timesheet module compute delivered qty for product [('type', 'in', ['service']), ('service_type', '=', 'timesheet')] """
-        super(SaleOrderLine, self)._compute_qty_delivered_method()
-        for line in self:
-            if not line.is_expense and line.product_id.type in ['service','product'] and line.product_id.service_type == 'timesheet':
-                line.qty_delivered_method = 'timesheet'
+    def _timesheet_service_generation(self):
+        lines = self
+        if not self.env.context.get('service_generation_cron'):
+            deferred_lines = self._get_service_generation_lines_to_defer()
+            if deferred_lines:
+                deferred_lines.service_generation_state = 'pending'
+                self._get_service_generation_cron()._trigger()
+                lines -= deferred_lines
+        if not lines:
+            return
+        lines._timesheet_create_global_project_tasks()
+        # the hours allocated to the projects are computed once for all the orders being confirmed
+        allocated_hours_per_order = lines._get_allocated_hours_per_project_template()
+        lines = lines.with_context(allocated_hours_per_project_template=allocated_hours_per_order)
+        lines._timesheet_create_new_projects()
+        return super(SaleOrderLine, lines)._timesheet_service_generation()
 
-    def _timesheet_create_project(self):
-        project = super()._timesheet_create_project()
-        project_uom = self.company_id.project_time_mode_id
+    def _get_service_generation_lines_to_defer(self):
+        """ Return the lines whose projects and tasks should be generated in the background: the ones of
+            the orders with at least as many lines to generate as the
+            `storable_service.deferred_generation_min_lines` system parameter (0, the default, disables it).
+        """
+        min_lines = int(self.env['ir.config_parameter'].sudo().get_param(
+            'storable_service.deferred_generation_min_lines', 0))
+        if not min_lines:
+            return self.browse()
+        lines = self._get_so_lines_new_project() | self._get_so_lines_task_global_project()
+        lines = lines.filtered(lambda line: line.service_generation_state != 'done')
+        line_ids_per_order = defaultdict(list)
+        for line in lines:
+            line_ids_per_order[line.order_id].append(line.id)
+        return self.browse([
+            line_id
+            for line_ids in line_ids_per_order.values() if len(line_ids) >= min_lines
+            for line_id in line_ids
+        ])
+
+    def _timesheet_create_global_project_tasks(self):
+        """ Create the tasks of the lines tracked in a global project through `_timesheet_create_task`. The
+            lines are then skipped by sale_project.
+
+            The tasks are created with one `create` per project, in the order of the project ids, whatever
+            the order of the lines. Inserting a task only takes a key share lock on its project row, but the
+            modules updating the project on task creation lock that row exclusively: as every confirmation
+            then locks its global projects in the same order, those spanning several of them queue up
+            instead of deadlocking.
+        """
+        lines = self._get_so_lines_task_global_project().filtered(
+            lambda line: not line.task_id and line.product_uom_qty > 0
+            and line.product_id.with_company(line.company_id).project_id
+        )
+        tasks = self.env['project.task']
+        if not lines:
+            return tasks
+        lines_per_project = defaultdict(lambda: self.env['sale.order.line'])
+        for line in lines:
+            lines_per_project[line.product_id.with_company(line.company_id).project_id] |= line
+        for project in sorted(lines_per_project, key=lambda project: project.id):
+            project_lines = lines_per_project[project]
+            project_tasks = self.env['project.task'].sudo().create([
+                line._timesheet_create_task_prepare_values(project) for line in project_lines
+            ])
+            # the lines still go through _timesheet_create_task, which picks up the task created for them
+            task_id_per_line_id = dict(zip(project_lines.ids, project_tasks.ids))
+            for line in project_lines.with_context(sale_line_created_task_ids=task_id_per_line_id):
+                tasks |= line._timesheet_create_task(project)
+        return tasks
+
+    def _timesheet_create_new_projects(self):
+        """ Create the projects without template of the orders of the lines with a single `create`. Each
+            project is linked to the line sale_project would create it for, so that sale_project finds it
+            and attaches the other lines of the order to it.
+        """
+        lines = self._get_so_lines_new_project().filtered(lambda line:
+            not line.project_id
+            and not line.product_id.project_template_id
+            and not (line.product_id.service_tracking == 'task_in_project' and line.order_id.project_id)
+        )
+        if not lines:
+            return self.env['project.project']
+        # as sale_project: an order gets a single project without template
+        orders_with_project = self.search([
+            ('order_id', 'in', lines.order_id.ids),
+            ('project_id', '!=', False),
+            ('product_id.service_tracking', 'in', ['project_only', 'task_in_project']),
+            ('product_id.project_template_id', '=', False),
+        ]).order_id
+        line_per_order = {}
+        for line in lines:
+            if line.order_id not in orders_with_project:
+                line_per_order.setdefault(line.order_id, line)
+        if not line_per_order:
+            return self.env['project.project']
+        allocated_hours_per_order = self.env.context.get('allocated_hours_per_project_template') or {}
+        if any(order.id not in allocated_hours_per_order for order in line_per_order):
+            allocated_hours_per_order = self._get_allocated_hours_per_project_template()
+        vals_list = []
+        for order, line in line_per_order.items():
+            vals = line._timesheet_create_project_prepare_values()
+            # as _timesheet_create_project
+            vals.update({
+                'name': f"{order.name} - {order.partner_id.name}",
+                'allocated_hours': allocated_hours_per_order[order.id].get(0, 0.0),
+                'allow_timesheets': True,
+            })
+            vals_list.append(vals)
+        # The no_create_folder context key is used in documents_project
+        projects = self.env['project.project'].sudo().with_context(no_create_folder=True).create(vals_list)
+        # Avoid new tasks to go to 'Undefined Stage', as sale_project does
+        self.env['project.task.type'].sudo().create([{
+            'name': name,
+            'fold': fold,
+            'sequence': sequence,
+            'project_ids': [Command.link(project.id)],
+        } for project in projects for name, fold, sequence in [
+            (_('To Do'), False, 5),
+            (_('In Progress'), False, 10),
+            (_('Done'), False, 15),
+            (_('Cancelled'), True, 20),
+        ]])
+        for line, project in zip(line_per_order.values(), projects):
+            line.project_id = project
+        return projects
+
+    def _timesheet_create_task(self, project):
+        task_id = self.env.context.get('sale_line_created_task_ids', {}).get(self.id)
+        if not task_id:
+            return super()._timesheet_create_task(project)
+        # the task was created in batch by _timesheet_create_global_project_tasks, the rest is done as in sale_project
+        task = self.env['project.task'].sudo().browse(task_id)
+        self.write({'task_id': task.id})
+        # post message on task
+        task_msg = _("This task has been created from: %s (%s)", self.order_id._get_html_link(), self.product_id.name)
+        task.message_post(body=task_msg)
+        return task
+
+    @api.model
+    def _cron_generate_pending_services(self, time_limit=600):
+        """ Generate the projects and tasks of the deferred lines, order after order. Each order is
+            committed on its own, and its lines are then marked as done so they are never generated twice,
+            or as failed so that they are not retried until requested from the order.
+        """
+        deadline = time.monotonic() + time_limit
+        lines = self.search([('service_generation_state', '=', 'pending')], order='order_id, id')
+        line_ids_per_order = defaultdict(list)
+        for line in lines:
+            line_ids_per_order[line.order_id.id].append(line.id)
+        for order_id, line_ids in line_ids_per_order.items():
+            if time.monotonic() > deadline:
+                self._get_service_generation_cron()._trigger()
+                return
+            order_lines = self.browse(line_ids)
+            order = order_lines.order_id
+            if order.state != 'sale':
+                # cancelled in the meantime: nothing to generate anymore
+                order_lines.service_generation_state = False
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    # as sale_project does on confirmation, in the company of the order
+                    order_lines.with_company(order.company_id).with_context(
+                        service_generation_cron=True)._timesheet_service_generation()
+                    order_lines.service_generation_state = 'done'
+            except Exception:
+                _logger.exception("Generation of the projects and tasks of sales order %s failed", order_id)
+                order_lines.service_generation_state = 'failed'
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+
+    @api.model
+    def _get_service_generation_cron(self):
+        # sale.order.line comes from sale: the xmlid belongs to the module of the jobs model, this one
+        return self.env.ref(f"{self.env['storable.service.job']._original_module}.ir_cron_generate_pending_services")
+
+    def _get_allocated_hours_per_project_template(self):
+        """ Compute the hours to allocate to the projects created for the orders of the lines: a project
+            gets the hours of all the lines of its order that share its project template.
+
+            :returns: a dict with the order id as key and, as value, a dict with the project template id
+                (0 for no template) as key and the allocated hours as value
+        """
         uom_unit = self.env.ref('uom.product_uom_unit')
         uom_hour = self.env.ref('uom.product_uom_hour')
+        allocated_hours_per_order = {}
+        for order in self.order_id:
+            project_uom = order.company_id.project_time_mode_id
+            # dict of inverse factors for each relevant UoM found in SO
+            factor_inv_per_id = {
+                uom.id: uom.factor_inv
+                for uom in order.order_line.product_uom
+                if uom.category_id == project_uom.category_id
+            }
+            # if sold as units, assume hours for time allocation
+            factor_inv_per_id[uom_unit.id] = uom_hour.factor_inv
 
-        # dict of inverse factors for each relevant UoM found in SO
-        factor_inv_per_id = {
-            uom.id: uom.factor_inv
-            for uom in self.order_id.order_line.product_uom
-            if uom.category_id == project_uom.category_id
-        }
-        # if sold as units, assume hours for time allocation
-        factor_inv_per_id[uom_unit.id] = uom_hour.factor_inv
+            allocated_hours_per_template = defaultdict(float)
+            for line in order.order_line:
+                if line.is_service \
+                        and line.product_service_tracking in ['task_in_project', 'project_only'] \
+                        and line.product_uom.id in factor_inv_per_id:
+                    uom_factor = project_uom.factor * factor_inv_per_id[line.product_uom.id]
+                    allocated_hours_per_template[line.product_id.project_template_id.id or 0] += line.product_uom_qty * uom_factor
+            allocated_hours_per_order[order.id] = dict(allocated_hours_per_template)
+        return allocated_hours_per_order
 
-        allocated_hours = 0.0
+    def _timesheet_create_project(self):
+        project = super()._timesheet_create_project()
+        allocated_hours_per_order = self.env.context.get('allocated_hours_per_project_template') or {}
+        if self.order_id.id not in allocated_hours_per_order:
+            allocated_hours_per_order = self._get_allocated_hours_per_project_template()
         # method only called once per project, so also allocate hours for
         # all lines in SO that will share the same project
-        for line in self.order_id.order_line:
-            if line.is_service \
-                    and line.product_id.service_tracking in ['task_in_project', 'project_only'] \
-                    and line.product_id.project_template_id == self.product_id.project_template_id \
-                    and line.product_uom.id in factor_inv_per_id:
-                uom_factor = project_uom.factor * factor_inv_per_id[line.product_uom.id]
-                allocated_hours += line.product_uom_qty * uom_factor
+        allocated_hours = allocated_hours_per_order[self.order_id.id].get(self.product_id.project_template_id.id or 0, 0.0)
 
         # Custom name formatting: SOname - Customer : Product
         new_project_name = f"{self.order_id.name} - {self.order_id.partner_id.name}"
@@ -183,9 +555,12 @@ class SaleOrderLine(models.Model):
             :param start_date: the start date of the period
             :param end_date: the end date of the period
         """
-        lines_by_timesheet = self.filtered(lambda sol: sol.product_id and sol.product_id._is_delivered_timesheet())
-        domain = lines_by_timesheet._timesheet_compute_delivered_quantity_domain()
-        refund_account_moves = self.order_id.invoice_ids.filtered(lambda am: am.state == 'posted' and am.move_type == 'out_refund').reversed_entry_id
+        # the refunds are searched directly rather than through the invoices of every order
+        refund_account_moves = self.env['account.move'].search([
+            ('move_type', '=', 'out_refund'),
+            ('state', '=', 'posted'),
+            ('line_ids.sale_line_ids.order_id', 'in', self.order_id.ids),
+        ]).reversed_entry_id
         timesheet_domain = [
             '|',
             ('timesheet_invoice_id', '=', False),
@@ -193,21 +568,32 @@ class SaleOrderLine(models.Model):
         if refund_account_moves:
             credited_timesheet_domain = [('timesheet_invoice_id.state', '=', 'posted'), ('timesheet_invoice_id', 'in', refund_account_moves.ids)]
             timesheet_domain = expression.OR([timesheet_domain, credited_timesheet_domain])
-        domain = expression.AND([domain, timesheet_domain])
         if start_date:
-            domain = expression.AND([domain, [('date', '>=', start_date)]])
+            timesheet_domain = expression.AND([timesheet_domain, [('date', '>=', start_date)]])
         if end_date:
-            domain = expression.AND([domain, [('date', '<=', end_date)]])
-        mapping = lines_by_timesheet.sudo()._get_delivered_quantity_by_analytic(domain)
+            timesheet_domain = expression.AND([timesheet_domain, [('date', '<=', end_date)]])
 
-        for line in lines_by_timesheet:
-            qty_to_invoice = mapping.get(line.id, 0.0)
-            if qty_to_invoice:
-                line.qty_to_invoice = qty_to_invoice
-            else:
-                prev_inv_status = line.invoice_status
-                line.qty_to_invoice = qty_to_invoice
-                line.invoice_status = prev_inv_status
+        for lines in split_every(QTY_TO_INVOICE_CHUNK_SIZE, self.ids, self.browse):
+            lines_by_timesheet = lines.filtered(lambda sol: sol.is_service and sol.product_service_policy == 'delivered_timesheet')
+            if not lines_by_timesheet:
+                continue
+            domain = expression.AND([lines_by_timesheet._timesheet_compute_delivered_quantity_domain(), timesheet_domain])
+            mapping = lines_by_timesheet.sudo()._get_delivered_quantity_by_analytic(domain)
+
+            line_ids_per_qty = defaultdict(list)
+            line_ids_per_inv_status = defaultdict(list)
+            for line in lines_by_timesheet:
+                qty_to_invoice = mapping.get(line.id, 0.0)
+                line_ids_per_qty[qty_to_invoice].append(line.id)
+                if not qty_to_invoice:
+                    line_ids_per_inv_status[line.invoice_status].append(line.id)
+            for qty_to_invoice, line_ids in line_ids_per_qty.items():
+                self.browse(line_ids).qty_to_invoice = qty_to_invoice
+            # a line without anything left to invoice keeps its invoice status
+            for invoice_status, line_ids in line_ids_per_inv_status.items():
+                self.browse(line_ids).invoice_status = invoice_status
+            self.env.flush_all()
+            lines.invalidate_recordset()
 
     def _get_action_per_item(self):
         """ Get action per Sales Order Item
@@ -218,12 +604,13 @@ class SaleOrderLine(models.Model):
         """
         action_per_sol = super()._get_action_per_item()
         timesheet_action = self.env.ref('sale_timesheet.timesheet_action_from_sales_order_item').id
-        timesheet_ids_per_sol = {}
+        timesheet_count_and_id_per_sol = {}
         if self.user_has_groups('hr_timesheet.group_hr_timesheet_user'):
-            timesheet_read_group = self.env['account.analytic.line']._read_group([('so_line', 'in', self.ids), ('project_id', '!=', False)], ['so_line'], ['id:array_agg'])
-            timesheet_ids_per_sol = {so_line.id: ids for so_line, ids in timesheet_read_group}
+            # only the count and one id are needed, not the ids of all the timesheets
+            timesheet_read_group = self.env['account.analytic.line']._read_group([('so_line', 'in', self.ids), ('project_id', '!=', False)], ['so_line'], ['__count', 'id:min'])
+            timesheet_count_and_id_per_sol = {so_line.id: (count, timesheet_id) for so_line, count, timesheet_id in timesheet_read_group}
         for sol in self:
-            timesheet_ids = timesheet_ids_per_sol.get(sol.id, [])
-            if sol.is_service and len(timesheet_ids) > 0:
-                action_per_sol[sol.id] = timesheet_action, timesheet_ids[0] if len(timesheet_ids) == 1 else False
+            timesheet_count, timesheet_id = timesheet_count_and_id_per_sol.get(sol.id, (0, False))
+            if sol.is_service and timesheet_count > 0:
+                action_per_sol[sol.id] = timesheet_action, timesheet_id if timesheet_count == 1 else False
         return action_per_sol
\ No newline at end of file
@@ -0,0 +1,134 @@
+from itertools import product as cartesian_product
+
+from odoo import api, models, tools
+from odoo.tools import frozendict
+
+# product types sold like services: storable products get the same project, timesheet and invoicing rules
+SERVICE_PRODUCT_TYPES = ('service', 'product')
+
+# Invoice type of the timesheets of a project sold with a service or a storable product invoiced on
+# delivery, per service type; delivered timesheets depend on the amount and other types are billed at a fixed price
+DELIVERED_TIMESHEET_INVOICE_TYPES = {
+    'milestones': 'billable_milestones',
+    'manual': 'billable_manual',
+}
+
+# Delivered quantity method of the non-expense lines selling a service or a storable product,
+# keyed by (product type, service type)
+QTY_DELIVERED_METHODS = {
+    ('service', 'timesheet'): 'timesheet',
+    ('product', 'timesheet'): 'timesheet',
+    ('service', 'milestones'): 'milestones',
+    ('product', 'milestones'): 'milestones',
+}
+
+
+class StorableServiceClassification(models.AbstractModel):
+    """ Classification of products, sale order items and timesheets as services
+
+        Every classification only depends on a few selection values, so it is resolved once for each
+        combination of these values and kept as an immutable table, cached per registry: the cache is
+        cleared when modules are installed or updated. The computes only look their key up.
+    """
+    _name = 'storable.service.classification'
+    _description = 'Storable Service Classification'
+
+    @api.model
+    def _get_selection_values(self, model_name, field_name):
+        """ Return the possible values of a selection field, including the empty one """
+        return [False] + self.env[model_name]._fields[field_name].get_values(self.env)
+
+    @api.model
+    def _get_product_keys(self):
+        """ Return all the (type, invoice policy, service type) combinations of products """
+        return cartesian_product(
+            self._get_selection_values('product.template', 'type'),
+            self._get_selection_values('product.template', 'invoice_policy'),
+            self._get_selection_values('product.template', 'service_type'),
+        )
+
+    @api.model
+    def _classify_service_policy(self, type_, invoice_policy, service_type):
+        service_policy = self.env['product.template']._get_general_to_service(invoice_policy, service_type)
+        if not service_policy and type_ in SERVICE_PRODUCT_TYPES:
+            service_policy = 'ordered_prepaid'
+        return service_policy
+
+    @api.model
+    @tools.ormcache()
+    def _get_service_policy_table(self):
+        """ Service policy of the products, keyed by (type, invoice policy, service type) """
+        return frozendict({key: self._classify_service_policy(*key) for key in self._get_product_keys()})
+
+    @api.model
+    def _get_service_policy(self, type_, invoice_policy, service_type):
+        key = (type_, invoice_policy, service_type)
+        table = self._get_service_policy_table()
+        return table[key] if key in table else self._classify_service_policy(*key)
+
+    @api.model
+    def _classify_profitability_invoice_type(self, type_, invoice_policy, service_type):
+        service_policy = None
+        if type_ in SERVICE_PRODUCT_TYPES:
+            service_policy = self.env['product.template']._get_general_to_service_map().get(
+                (invoice_policy, service_type), 'ordered_prepaid')
+        return self.env['project.project']._get_service_policy_to_invoice_type().get(service_policy, 'materials')
+
+    @api.model
+    @tools.ormcache()
+    def _get_profitability_invoice_type_table(self):
+        """ Revenue section of the profitability panel of the products, keyed by (type, invoice policy, service type) """
+        return frozendict({key: self._classify_profitability_invoice_type(*key) for key in self._get_product_keys()})
+
+    @api.model
+    def _get_profitability_invoice_type(self, type_, invoice_policy, service_type):
+        key = (type_, invoice_policy, service_type)
+        table = self._get_profitability_invoice_type_table()
+        return table[key] if key in table else self._classify_profitability_invoice_type(*key)
+
+    @api.model
+    def _classify_qty_delivered_method(self, is_expense, type_, service_type):
+        """ Return the delivered quantity method of sale order items, or None to leave it to the sale modules """
+        return 'analytic' if is_expense else QTY_DELIVERED_METHODS.get((type_, service_type))
+
+    @api.model
+    @tools.ormcache()
+    def _get_qty_delivered_method_table(self):
+        """ Delivered quantity method of sale order items, keyed by (is expense, product type, service type) """
+        return frozendict({
+            key: self._classify_qty_delivered_method(*key)
+            for key in cartesian_product(
+                [False, True],
+                self._get_selection_values('product.template', 'type'),
+                self._get_selection_values('product.template', 'service_type'),
+            )
+        })
+
+    @api.model
+    def _get_qty_delivered_method(self, is_expense, type_, service_type):
+        key = (is_expense, type_, service_type)
+        table = self._get_qty_delivered_method_table()
+        return table[key] if key in table else self._classify_qty_delivered_method(*key)
+
+    @api.model
+    @tools.ormcache()
+    def _get_timesheet_invoice_type_table(self):
+        """ Invoice type of timesheets, keyed as :meth:`account.analytic.line._get_timesheet_invoice_type_from_key` """
+        AnalyticLine = self.env['account.analytic.line']
+        return frozendict({
+            key: AnalyticLine._get_timesheet_invoice_type_from_key(*key)
+            for key in cartesian_product(
+                [False, True],
+                self._get_selection_values('project.project', 'billing_type'),
+                [False, True],
+                [False, True],
+                self._get_selection_values('product.template', 'invoice_policy'),
+                self._get_selection_values('product.template', 'service_type'),
+                [-1, 0, 1],
+            )
+        })
+
+    @api.model
+    def _get_timesheet_invoice_type(self, *key):
+        table = self._get_timesheet_invoice_type_table()
+        return table[key] if key in table else self.env['account.analytic.line']._get_timesheet_invoice_type_from_key(*key)
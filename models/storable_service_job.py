@@ -0,0 +1,236 @@
+import logging
+import time
+
+from odoo import api, fields, models, _
+
+_logger = logging.getLogger(__name__)
+
+JOB_CHUNK_SIZE = 5000
+JOB_TIME_LIMIT = 600  # seconds a cron run may spend before handing over to the next one
+
+# the active products sold as services or storable products
+SERVICE_PRODUCT_TEMPLATE_WHERE = """
+    pt.type IN ('service', 'product')
+    AND EXISTS (SELECT 1 FROM product_product pp WHERE pp.product_tmpl_id = pt.id AND pp.active)
+"""
+PRODUCT_TEMPLATE_COUNT_QUERY = f"""
+    SELECT COUNT(*) FROM product_template pt WHERE {SERVICE_PRODUCT_TEMPLATE_WHERE}
+"""
+PRODUCT_TEMPLATE_CHUNK_QUERY = f"""
+    SELECT pt.id FROM product_template pt
+     WHERE pt.id > %(last_id)s AND {SERVICE_PRODUCT_TEMPLATE_WHERE}
+  ORDER BY pt.id
+     LIMIT %(limit)s
+"""
+SALE_LINE_FROM = """
+    FROM sale_order_line sol
+    JOIN product_product pp ON pp.id = sol.product_id AND pp.active
+    JOIN product_template pt ON pt.id = pp.product_tmpl_id AND pt.type IN ('service', 'product')
+"""
+SALE_LINE_COUNT_QUERY = f"SELECT COUNT(*) {SALE_LINE_FROM}"
+SALE_LINE_CHUNK_QUERY = f"""
+    SELECT sol.id {SALE_LINE_FROM}
+     WHERE sol.id > %(last_id)s
+  ORDER BY sol.id
+     LIMIT %(limit)s
+"""
+
+
+class StorableServiceJob(models.Model):
+    _name = 'storable.service.job'
+    _description = 'Storable Service Background Job'
+    _order = 'id desc'
+
+    name = fields.Char(required=True, readonly=True)
+    job_type = fields.Selection([
+        ('timesheet_invoice_type', 'Timesheet Invoice Type Recompute'),
+        ('milestones_disabled', 'Milestones Deactivation'),
+    ], required=True, readonly=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ], default='queued', required=True, readonly=True)
+    step = fields.Selection([
+        ('products', 'Products'),
+        ('sale_lines', 'Sales Order Items'),
+    ], readonly=True)
+    product_ids = fields.Many2many('product.product', string='Products', readonly=True)
+    last_id = fields.Integer("Last Processed ID", readonly=True)
+    total_count = fields.Integer("To Process", readonly=True)
+    done_count = fields.Integer("Processed", readonly=True)
+    updated_count = fields.Integer("Updated", readonly=True)
+    progress = fields.Float(compute='_compute_progress')
+    error = fields.Text(readonly=True)
+
+    @api.depends('done_count', 'total_count', 'state')
+    def _compute_progress(self):
+        for job in self:
+            if job.state == 'done':
+                job.progress = 100.0
+            else:
+                job.progress = 100.0 * job.done_count / job.total_count if job.total_count else 0.0
+
+    @api.model
+    def _enqueue_timesheet_invoice_type(self, products):
+        """ Queue the recompute of the invoice type of the timesheets sold with the given products """
+        timesheet_domain = [('so_line.product_id', 'in', products.ids)]
+        if not products or not self.env['account.analytic.line'].sudo().search_count(timesheet_domain, limit=1):
+            return self
+        job = self.sudo().search([('job_type', '=', 'timesheet_invoice_type'), ('state', '=', 'queued')], limit=1)
+        if job:
+            # not started yet, so it can simply take the new products along
+            job.product_ids = [fields.Command.link(product_id) for product_id in products.ids]
+        else:
+            job = self.sudo().create({
+                'name': ', '.join(products[:3].mapped('display_name')) + ('...' if len(products) > 3 else ''),
+                'job_type': 'timesheet_invoice_type',
+                'product_ids': [fields.Command.set(products.ids)],
+            })
+        self._get_cron()._trigger()
+        return job
+
+    @api.model
+    def _enqueue_milestones_disabled(self):
+        """ Queue the switch of the products and their sale order items from milestones to manual delivery """
+        job = self.sudo().search([('job_type', '=', 'milestones_disabled'), ('state', '=', 'queued')], limit=1)
+        if not job:
+            job = self.sudo().create({
+                'name': _("Deactivation of the milestones"),
+                'job_type': 'milestones_disabled',
+            })
+        self._get_cron()._trigger()
+        return job
+
+    @api.model
+    def _cancel_jobs(self, job_type):
+        self.sudo().search([('job_type', '=', job_type), ('state', 'in', ['queued', 'running'])]).state = 'cancelled'
+
+    @api.model
+    def _get_cron(self):
+        return self.env.ref(f'{self._original_module}.ir_cron_process_storable_service_jobs')
+
+    @api.model
+    def _cron_process_jobs(self, time_limit=JOB_TIME_LIMIT):
+        """ Process the pending jobs chunk by chunk, committing after each chunk. When the time limit is
+            reached, the cron is triggered again to go on with the remaining chunks.
+        """
+        deadline = time.monotonic() + time_limit
+        for job in self.search([('state', 'in', ['queued', 'running'])], order='id'):
+            while job.state in ['queued', 'running']:
+                if time.monotonic() > deadline:
+                    self._get_cron()._trigger()
+                    return
+                try:
+                    with self.env.cr.savepoint():
+                        getattr(job, '_process_chunk_%s' % job.job_type)()
+                except Exception as e:
+                    _logger.exception("Storable service job %s failed", job.id)
+                    job.write({'state': 'failed', 'error': str(e)})
+                if not self.env.registry.in_test_mode():
+                    self.env.cr.commit()
+
+    def _process_chunk_timesheet_invoice_type(self):
+        self.ensure_one()
+        timesheet_domain = [('so_line.product_id', 'in', self.product_ids.ids)]
+        AnalyticLine = self.env['account.analytic.line'].sudo()
+        if self.state == 'queued':
+            self.write({
+                'state': 'running',
+                'total_count': AnalyticLine.search_count(timesheet_domain),
+            })
+        timesheets = AnalyticLine.search(timesheet_domain + [('id', '>', self.last_id)], order='id', limit=JOB_CHUNK_SIZE)
+        if not timesheets:
+            self.state = 'done'
+            return
+        updated_count = timesheets._update_outdated_timesheet_invoice_type()
+        self.write({
+            'last_id': timesheets[-1].id,
+            'done_count': self.done_count + len(timesheets),
+            'updated_count': self.updated_count + updated_count,
+        })
+        timesheets.invalidate_recordset()
+
+    def _update_sale_line_product_service_fields(self, template_ids):
+        """ Update the copies of the product service attributes stored on the sale order items of the given
+            templates, switched to manual delivery behind the ORM's back
+        """
+        service_policy = self.env['storable.service.classification']._get_service_policy('service', 'delivery', 'manual')
+        SaleOrderLine = self.env['sale.order.line']
+        SaleOrderLine.flush_model(['product_id', 'product_service_type', 'product_service_policy'])
+        self.env.cr.execute("""
+            UPDATE sale_order_line sol
+               SET product_service_type = 'manual', product_service_policy = %(service_policy)s
+              FROM product_product pp
+             WHERE pp.id = sol.product_id
+               AND pp.product_tmpl_id IN %(template_ids)s
+               AND (sol.product_service_type, sol.product_service_policy) IS DISTINCT FROM ('manual', %(service_policy)s)
+         RETURNING sol.id
+        """, {'service_policy': service_policy, 'template_ids': tuple(template_ids)})
+        lines = SaleOrderLine.browse([row[0] for row in self.env.cr.fetchall()])
+        lines.invalidate_recordset(['product_service_type', 'product_service_policy'])
+        # what the ORM does for these fields: let the fields depending on them follow
+        lines.modified(['product_service_type', 'product_service_policy'])
+
+    def _process_chunk_milestones_disabled(self):
+        """ Set the products sold as services or storable products to manual delivery, then the delivered
+            method of their sale order items to manual, only writing the rows whose value changes.
+        """
+        self.ensure_one()
+        cr = self.env.cr
+        if self.state == 'queued':
+            cr.execute(PRODUCT_TEMPLATE_COUNT_QUERY)
+            total_count = cr.fetchone()[0]
+            cr.execute(SALE_LINE_COUNT_QUERY)
+            total_count += cr.fetchone()[0]
+            self.write({'state': 'running', 'step': 'products', 'last_id': 0, 'total_count': total_count})
+        if self.step == 'products':
+            self.env['product.template'].flush_model(['invoice_policy', 'service_type'])
+            cr.execute(PRODUCT_TEMPLATE_CHUNK_QUERY, {'last_id': self.last_id, 'limit': JOB_CHUNK_SIZE})
+            chunk_ids = [row[0] for row in cr.fetchall()]
+            if not chunk_ids:
+                self.write({'step': 'sale_lines', 'last_id': 0})
+                return
+            cr.execute("""
+                UPDATE product_template
+                   SET invoice_policy = 'delivery', service_type = 'manual',
+                       write_uid = %s, write_date = NOW() AT TIME ZONE 'UTC'
+                 WHERE id IN %s
+                   AND (invoice_policy, service_type) IS DISTINCT FROM ('delivery', 'manual')
+             RETURNING id
+            """, [self.env.uid, tuple(chunk_ids)])
+            updated_ids = [row[0] for row in cr.fetchall()]
+            templates = self.env['product.template'].browse(updated_ids)
+            templates.invalidate_recordset(['invoice_policy', 'service_type'])
+            if updated_ids:
+                self._update_sale_line_product_service_fields(updated_ids)
+            # what product.template.write does when these fields change
+            products = templates.with_context(active_test=False).product_variant_ids
+            self._enqueue_timesheet_invoice_type(products)
+        else:
+            self.env['sale.order.line'].flush_model(['qty_delivered_method'])
+            cr.execute(SALE_LINE_CHUNK_QUERY, {'last_id': self.last_id, 'limit': JOB_CHUNK_SIZE})
+            chunk_ids = [row[0] for row in cr.fetchall()]
+            if not chunk_ids:
+                self.write({'state': 'done', 'step': False})
+                return
+            cr.execute("""
+                UPDATE sale_order_line
+                   SET qty_delivered_method = 'manual'
+                 WHERE id IN %s
+                   AND qty_delivered_method IS DISTINCT FROM 'manual'
+             RETURNING id
+            """, [tuple(chunk_ids)])
+            updated_ids = [row[0] for row in cr.fetchall()]
+            lines = self.env['sale.order.line'].browse(updated_ids)
+            lines.invalidate_recordset(['qty_delivered_method'])
+            # let the delivered quantities follow the new method
+            lines.modified(['qty_delivered_method'])
+            self.env.flush_all()
+        self.write({
+            'last_id': chunk_ids[-1],
+            'done_count': self.done_count + len(chunk_ids),
+            'updated_count': self.updated_count + len(updated_ids),
+        })
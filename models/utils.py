@@ -0,0 +1,43 @@
+import logging
+
+_logger = logging.getLogger(__name__)
+
+BACKFILL_CHUNK_SIZE = 50000
+
+
+def update_by_id_ranges(env, table, query, label, params=None, chunk_size=BACKFILL_CHUNK_SIZE):
+    """ Run a set-based ``UPDATE`` over consecutive id ranges of ``table``.
+
+        The query receives ``%(id_from)s`` and ``%(id_to)s`` (upper bound excluded) and must only
+        touch the rows whose value actually changes. A transaction is committed after each range
+        and the next lower bound is kept in an ``ir.config_parameter``, so an interrupted run can
+        simply be started again and resumes where it stopped.
+
+        :param env: environment used to run the query
+        :param table: table whose ids are used to split the work
+        :param query: the ``UPDATE`` query to run for each id range
+        :param label: name of the backfill, used for logging and for the checkpoint key
+        :param params: extra parameters given to the query
+        :param chunk_size: number of ids covered by each range
+        :returns: the number of updated rows
+    """
+    cr = env.cr
+    config_parameter = env['ir.config_parameter'].sudo()
+    checkpoint_key = 'storable_service.backfill.%s' % label
+    id_from = int(config_parameter.get_param(checkpoint_key, 0))
+    cr.execute(f'SELECT MAX(id) FROM "{table}"')
+    max_id = cr.fetchone()[0] or 0
+    if id_from:
+        _logger.info("%s: resuming from id %s", label, id_from)
+    updated = 0
+    while id_from <= max_id:
+        id_to = id_from + chunk_size
+        cr.execute(query, dict(params or {}, id_from=id_from, id_to=id_to))
+        updated += cr.rowcount
+        config_parameter.set_param(checkpoint_key, id_to)
+        if not env.registry.in_test_mode():
+            cr.commit()
+        _logger.info("%s: %s/%s ids processed, %s rows updated", label, min(id_to, max_id), max_id, updated)
+        id_from = id_to
+    config_parameter.set_param(checkpoint_key, False)
+    return updated
@@ -0,0 +1,7 @@
+from . import test_global_project_task_concurrency
+from . import test_project_profitability
+from . import test_timesheet_service_generation
+from . import test_timesheet_action_per_item
+from . import test_sale_order_line_indexes
+from . import test_product_tooltip
+from . import test_sale_order_upsell
@@ -0,0 +1,28 @@
+def clone_records(records, count, values=None, params=None):
+    """ Insert ``count`` copies of the records, in turn, straight into the database
+
+        :param values: a dict with a column name as key and, as value, the SQL expression giving the column
+            of the copies instead of the one of the record, in which ``serie`` is the number of the copy
+        :param params: the parameters of these expressions, as ``%(name)s`` placeholders
+        :returns: the copies
+    """
+    env = records.env
+    env.flush_all()
+    env.cr.execute("""
+        SELECT column_name
+          FROM information_schema.columns
+         WHERE table_name = %s
+           AND column_name != 'id'
+    """, [records._table])
+    columns = [column for column, in env.cr.fetchall()]
+    values = values or {}
+    env.cr.execute(f"""
+        INSERT INTO {records._table} ({', '.join(f'"{column}"' for column in columns)})
+             SELECT {', '.join(values.get(column, f'"{column}"') for column in columns)}
+               FROM generate_series(0, %(count)s - 1) serie
+               JOIN {records._table} ON {records._table}.id = (%(record_ids)s::int[])[1 + serie %% %(record_count)s]
+          RETURNING id
+    """, {**(params or {}), 'count': count, 'record_ids': records.ids, 'record_count': len(records)})
+    copies = records.browse(id_ for id_, in env.cr.fetchall())
+    env.invalidate_all()
+    return copies
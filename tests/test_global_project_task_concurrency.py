@@ -0,0 +1,183 @@
+import logging
+import threading
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from psycopg2.errors import DeadlockDetected, SerializationFailure
+
+from odoo import api, Command, SUPERUSER_ID
+from odoo.modules.registry import Registry
+from odoo.sql_db import db_connect
+from odoo.tests import BaseCase, get_db_name, tagged
+
+_logger = logging.getLogger(__name__)
+
+# name of the records of the test, so that the leftovers of an interrupted run can be found again
+TEST_RECORDS_NAME = 'Storable Service Concurrency'
+
+
+@tagged('post_install', '-at_install')
+class TestGlobalProjectTaskConcurrency(BaseCase):
+    """ Orders selling storable products tracked in global projects are confirmed in parallel, each by a
+        worker with its own database connection, as concurrent salespeople would do. The data is committed
+        so that every connection sees it, and removed afterwards, or by the next run if that failed.
+    """
+    WORKERS = 8
+
+    def setUp(self):
+        super().setUp()
+        self.db_connection = db_connect(get_db_name())
+        self._remove_data()
+        self.addCleanup(self._remove_data)
+        with self.db_connection.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            partner = env['res.partner'].create({'name': TEST_RECORDS_NAME})
+            projects = env['project.project'].create([{
+                'name': f'{TEST_RECORDS_NAME} {index}',
+                'partner_id': partner.id,
+                'allow_billable': True,
+            } for index in range(2)])
+            products = env['product.product'].create([{
+                'name': f'{TEST_RECORDS_NAME} {project.name}',
+                'type': 'product',
+                'invoice_policy': 'order',
+                'service_tracking': 'task_global_project',
+                'project_id': project.id,
+            } for project in projects])
+            self.partner_id, self.project_ids, self.product_ids = partner.id, projects.ids, products.ids
+
+    def _remove_data(self):
+        """ Remove the records of the test, each kind on its own so that a failure leaves as little as possible """
+        with self.db_connection.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {'active_test': False})
+            partners = env['res.partner'].search([('name', '=', TEST_RECORDS_NAME)])
+            if not partners:
+                return
+            projects = env['project.project'].search([('partner_id', 'in', partners.ids)])
+            analytic_accounts = projects.analytic_account_id
+            orders = env['sale.order'].search([('partner_id', 'in', partners.ids)])
+            steps = [
+                lambda: env['project.task'].search([('project_id', 'in', projects.ids)]).unlink(),
+                lambda: orders._action_cancel(),
+                lambda: orders.unlink(),
+                lambda: env['product.template'].search([('name', '=like', f'{TEST_RECORDS_NAME} %')]).unlink(),
+                lambda: projects.unlink(),
+                lambda: analytic_accounts.unlink(),
+                lambda: partners.unlink(),
+            ]
+            for step in steps:
+                try:
+                    with cr.savepoint():
+                        step()
+                except Exception:
+                    _logger.exception("Removal of the records of %s failed", self)
+
+    def _create_orders(self, product_indexes_per_order):
+        with self.db_connection.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            orders = env['sale.order'].create([{
+                'partner_id': self.partner_id,
+                'order_line': [
+                    Command.create({'product_id': self.product_ids[index], 'product_uom_qty': 1})
+                    for index in product_indexes
+                ],
+            } for product_indexes in product_indexes_per_order])
+            return orders.ids
+
+    def _confirm_order(self, order_id, barrier, failures):
+        try:
+            with self.db_connection.cursor() as cr:
+                order = api.Environment(cr, SUPERUSER_ID, {})['sale.order'].browse(order_id)
+                order.fetch(['state'])
+                barrier.wait()
+                order.action_confirm()
+        except (SerializationFailure, DeadlockDetected) as e:
+            failures.append(e)
+
+    def _confirm_orders_in_parallel(self, order_ids):
+        """ Confirm each order in its own worker, all at the same time
+
+            :returns: the serialization failures and deadlocks the workers ran into
+        """
+        barrier = threading.Barrier(len(order_ids))
+        failures = []
+        workers = [
+            threading.Thread(target=self._confirm_order, args=(order_id, barrier, failures))
+            for order_id in order_ids
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return failures
+
+    @contextmanager
+    def _lock_projects_on_task_creation(self, workers):
+        """ Make the creation of tasks update the row of their project, as extensions keeping counters
+            on projects do. The first lock of each worker waits for the others to take theirs, so that
+            the workers interleave whatever their speed.
+        """
+        Task = Registry(get_db_name())['project.task']
+        create = Task.create
+        locks_taken = threading.Barrier(workers)
+
+        def create_locking_projects(self, vals_list):
+            for vals in [vals_list] if isinstance(vals_list, dict) else vals_list:
+                self.env.cr.execute(
+                    "SELECT id FROM project_project WHERE id = %s FOR NO KEY UPDATE", [vals['project_id']])
+                if not self.env.cr.cache.get('test_project_locked'):
+                    self.env.cr.cache['test_project_locked'] = True
+                    try:
+                        locks_taken.wait(timeout=3)
+                    except threading.BrokenBarrierError:
+                        # the other workers wait for this lock
+                        pass
+            return create(self, vals_list)
+
+        with patch.object(Task, 'create', create_locking_projects):
+            yield
+
+    def _get_tasks(self):
+        with self.db_connection.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            tasks = env['project.task'].search([('project_id', 'in', self.project_ids)])
+            return [(task.project_id.id, task.sale_line_id.order_id.id, task.sale_line_id.product_id.id) for task in tasks]
+
+    def test_parallel_confirmation_in_global_project(self):
+        order_ids = self._create_orders([[0]] * self.WORKERS)
+        failures = self._confirm_orders_in_parallel(order_ids)
+
+        self.assertFalse(failures, "No confirmation should have to be retried")
+        with self.db_connection.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            orders = env['sale.order'].browse(order_ids)
+            self.assertEqual(set(orders.mapped('state')), {'sale'})
+            tasks = env['project.task'].search([('project_id', '=', self.project_ids[0])])
+            self.assertEqual(len(tasks), self.WORKERS, "Each order should get exactly one task")
+            self.assertEqual(tasks.sale_line_id, orders.order_line)
+            self.assertEqual(orders.order_line.task_id, tasks)
+
+    def test_parallel_confirmation_across_global_projects(self):
+        # the lines of the two orders go to the two projects in opposite orders
+        order_ids = self._create_orders([[0, 1], [1, 0]])
+        with self._lock_projects_on_task_creation(len(order_ids)):
+            failures = self._confirm_orders_in_parallel(order_ids)
+
+        self.assertFalse(failures, "The tasks should be created project after project, in the same order for all orders")
+        self.assertEqual(sorted(self._get_tasks()), sorted(
+            (self.project_ids[index], order_id, self.product_ids[index])
+            for order_id in order_ids for index in range(2)
+        ))
+
+    def test_parallel_confirmation_across_global_projects_in_line_order(self):
+        # without the batch creation, sale_project creates the tasks line after line: the workers lock the
+        # projects in opposite orders and one of them is stopped by a deadlock
+        order_ids = self._create_orders([[0, 1], [1, 0]])
+        SaleOrderLine = Registry(get_db_name())['sale.order.line']
+        with self._lock_projects_on_task_creation(len(order_ids)), \
+                patch.object(SaleOrderLine, '_timesheet_create_global_project_tasks',
+                             lambda self: self.env['project.task']):
+            failures = self._confirm_orders_in_parallel(order_ids)
+
+        self.assertEqual(len(failures), 1)
+        self.assertIsInstance(failures[0], DeadlockDetected)
@@ -0,0 +1,139 @@
+import logging
+import time
+from itertools import product as cartesian_product
+
+from odoo import _
+from odoo.tests import TransactionCase, tagged
+
+from .common import clone_records
+from ..models.product import ProductTemplate
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install')
+class TestProductTooltip(TransactionCase):
+    """ Benchmark of the tooltips of 100,000 product templates against the former if/elif cascade """
+    TEMPLATES = 100000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        seeds = cls.env['product.template'].create([{
+            'name': f'Tooltip {type_} {invoice_policy} {service_type} {service_tracking}',
+            'type': type_,
+            'invoice_policy': invoice_policy,
+            'service_type': service_type,
+            'service_tracking': service_tracking,
+        } for type_, (invoice_policy, service_type), service_tracking in cartesian_product(
+            ['product', 'service'],
+            [('order', 'manual'), ('delivery', 'milestones'), ('delivery', 'manual'), ('delivery', 'timesheet')],
+            ['no', 'task_global_project', 'project_only', 'task_in_project'],
+        )])
+        cls.templates = seeds | clone_records(seeds, cls.TEMPLATES - len(seeds))
+
+    def _get_reference_tooltip(self, record):
+        """ The tooltip of the product as computed before the table of messages, with a translation per record """
+        if record.service_policy == 'ordered_prepaid':
+            if record.service_tracking == 'no':
+                return _(
+                    "Invoice ordered quantities as soon as this service is sold."
+                )
+            elif record.service_tracking == 'task_global_project':
+                return _(
+                    "Invoice ordered quantities as soon as this service is sold. "
+                    "Create a task in an existing project to track the time spent."
+                )
+            elif record.service_tracking == 'project_only':
+                return _(
+                    "Invoice ordered quantities as soon as this service is sold. "
+                    "Create an empty project for the order to track the time spent."
+                )
+            elif record.service_tracking == 'task_in_project':
+                return _(
+                    "Invoice ordered quantities as soon as this service is sold. "
+                    "Create a project for the order with a task for each sales order line "
+                    "to track the time spent."
+                )
+        elif record.service_policy == 'delivered_milestones':
+            if record.service_tracking == 'no':
+                return _(
+                    "Invoice your milestones when they are reached."
+                )
+            elif record.service_tracking == 'task_global_project':
+                return _(
+                    "Invoice your milestones when they are reached. "
+                    "Create a task in an existing project to track the time spent."
+                )
+            elif record.service_tracking == 'project_only':
+                return _(
+                    "Invoice your milestones when they are reached. "
+                    "Create an empty project for the order to track the time spent."
+                )
+            elif record.service_tracking == 'task_in_project':
+                return _(
+                    "Invoice your milestones when they are reached. "
+                    "Create a project for the order with a task for each sales order line "
+                    "to track the time spent."
+                )
+        elif record.service_policy == 'delivered_manual':
+            if record.service_tracking == 'no':
+                return _(
+                    "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
+                )
+            elif record.service_tracking == 'task_global_project':
+                return _(
+                    "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
+                    "Create a task in an existing project to track the time spent."
+                )
+            elif record.service_tracking == 'project_only':
+                return _(
+                    "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
+                    "Create an empty project for the order to track the time spent."
+                )
+            elif record.service_tracking == 'task_in_project':
+                return _(
+                    "Invoice this service when it is delivered (set the quantity by hand on your sales order lines). "
+                    "Create a project for the order with a task for each sales order line "
+                    "to track the time spent."
+                )
+        return None
+
+    def _compute_reference_tooltips(self, templates):
+        """ The compute of the tooltips before the table of messages: the one of the sale modules, then
+            the cascade for the services and storable products they are sold as.
+        """
+        super(ProductTemplate, templates)._compute_product_tooltip()
+        for record in templates.filtered(lambda record: record.type in ['service', 'product'] and record.sale_ok):
+            tooltip = self._get_reference_tooltip(record)
+            if tooltip:
+                record.product_tooltip = tooltip
+
+    def _time_compute(self, compute, templates):
+        """ Return the best of three durations of ``compute`` on the templates, and the tooltips it gave """
+        field = templates._fields['product_tooltip']
+        durations = []
+        for __ in range(3):
+            templates.invalidate_recordset(['product_tooltip'])
+            with self.env.protecting([field], templates):
+                start = time.perf_counter()
+                compute(templates)
+                durations.append(time.perf_counter() - start)
+            tooltips = [self.env.cache.get(record, field) for record in templates]
+        return min(durations), tooltips
+
+    def test_tooltips_of_many_templates(self):
+        templates = self.templates
+        self.assertEqual(len(templates), self.TEMPLATES)
+        # the fields the tooltips depend on are read beforehand, so that only the tooltips are timed
+        for field_name in ['type', 'sale_ok', 'service_policy', 'service_tracking']:
+            templates.mapped(field_name)
+
+        # both computes go through the one of the sale modules and write the tooltips in the cache
+        reference_duration, reference_tooltips = self._time_compute(self._compute_reference_tooltips, templates)
+        duration, tooltips = self._time_compute(lambda templates: templates._compute_product_tooltip(), templates)
+        _logger.info("Tooltips of %s product templates: %.2fs with the table of messages, %.2fs with the former "
+                     "cascade", self.TEMPLATES, duration, reference_duration)
+
+        self.assertEqual(tooltips, reference_tooltips)
+        self.assertLess(duration, reference_duration)
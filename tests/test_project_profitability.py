@@ -0,0 +1,285 @@
+import json
+from collections import defaultdict
+from datetime import timedelta
+from itertools import cycle, product as cartesian_product
+
+from unittest.mock import patch
+
+from odoo import Command, fields
+from odoo.tests import TransactionCase, tagged
+
+
+def get_revenues_items_from_sol_reference(project, domain=None, with_action=True):
+    """ The revenues of the project as computed before the single pass over the products, group after
+        group of products and product after product.
+    """
+    sale_line_read_group = project.env['sale.order.line'].sudo()._read_group(
+        project._get_profitability_sale_order_items_domain(domain),
+        ['currency_id', 'product_id', 'is_downpayment'],
+        ['id:array_agg', 'untaxed_amount_to_invoice:sum', 'untaxed_amount_invoiced:sum'],
+    )
+    display_sol_action = with_action and len(project) == 1 and project.user_has_groups('sales_team.group_sale_salesman')
+    revenues_dict = {}
+    total_to_invoice = total_invoiced = 0.0
+    data = []
+    sequence_per_invoice_type = project._get_profitability_sequence_per_invoice_type()
+    if sale_line_read_group:
+        convert_company = project.company_id or project.env.company
+        sols_per_product = defaultdict(lambda: [0.0, 0.0, []])
+        downpayment_amount_invoiced = 0
+        downpayment_sol_ids = []
+        for currency, product, is_downpayment, sol_ids, untaxed_amount_to_invoice, untaxed_amount_invoiced in sale_line_read_group:
+            if is_downpayment:
+                downpayment_amount_invoiced += currency._convert(untaxed_amount_invoiced, convert_company.currency_id, convert_company, round=False)
+                downpayment_sol_ids += sol_ids
+            else:
+                sols_per_product[product.id][0] += currency._convert(untaxed_amount_to_invoice, convert_company.currency_id, convert_company)
+                sols_per_product[product.id][1] += currency._convert(untaxed_amount_invoiced, convert_company.currency_id, convert_company)
+                sols_per_product[product.id][2] += sol_ids
+        if downpayment_amount_invoiced:
+            downpayments_data = {
+                'id': 'downpayments',
+                'sequence': sequence_per_invoice_type['downpayments'],
+                'invoiced': downpayment_amount_invoiced,
+                'to_invoice': -downpayment_amount_invoiced
+            }
+            if with_action and project.user_has_groups('sales_team.group_sale_salesman_all_leads, account.group_account_invoice, account.group_account_readonly'):
+                invoices = project.env['account.move'].search([('line_ids.sale_line_ids', 'in', downpayment_sol_ids)])
+                args = ['downpayments', [('id', 'in', invoices.ids)]]
+                if len(invoices) == 1:
+                    args.append(invoices.id)
+                downpayments_data['action'] = {
+                    'name': 'action_profitability_items',
+                    'type': 'object',
+                    'args': json.dumps(args),
+                }
+            data += [downpayments_data]
+            total_invoiced += downpayment_amount_invoiced
+            total_to_invoice -= downpayment_amount_invoiced
+        product_read_group = project.env['product.product'].sudo()._read_group(
+            [('id', 'in', list(sols_per_product))],
+            ['invoice_policy', 'service_type', 'type'],
+            ['id:array_agg'],
+        )
+        service_policy_to_invoice_type = project._get_service_policy_to_invoice_type()
+        general_to_service_map = project.env['product.template']._get_general_to_service_map()
+        for invoice_policy, service_type, type_, product_ids in product_read_group:
+            service_policy = None
+            if type_ in ['service', 'product']:
+                service_policy = general_to_service_map.get((invoice_policy, service_type), 'ordered_prepaid')
+            for product_id, (amount_to_invoice, amount_invoiced, sol_ids) in sols_per_product.items():
+                if product_id in product_ids:
+                    invoice_type = service_policy_to_invoice_type.get(service_policy, 'materials')
+                    revenue = revenues_dict.setdefault(invoice_type, {'invoiced': 0.0, 'to_invoice': 0.0})
+                    revenue['to_invoice'] += amount_to_invoice
+                    total_to_invoice += amount_to_invoice
+                    revenue['invoiced'] += amount_invoiced
+                    total_invoiced += amount_invoiced
+                    if display_sol_action and invoice_type in ['service_revenues', 'materials']:
+                        revenue.setdefault('record_ids', []).extend(sol_ids)
+        if display_sol_action:
+            materials = revenues_dict.get('materials', {})
+            sale_order_items = project.env['sale.order.line'] \
+                .browse(materials.pop('record_ids', [])) \
+                ._filter_access_rules_python('read')
+            if sale_order_items:
+                args = ['materials', [('id', 'in', sale_order_items.ids)]]
+                if len(sale_order_items) == 1:
+                    args.append(sale_order_items.id)
+                action_params = {
+                    'name': 'action_profitability_items',
+                    'type': 'object',
+                    'args': json.dumps(args),
+                }
+                if len(sale_order_items) == 1:
+                    action_params['res_id'] = sale_order_items.id
+                materials['action'] = action_params
+    data += [{
+        'id': invoice_type,
+        'sequence': sequence_per_invoice_type[invoice_type],
+        **vals,
+    } for invoice_type, vals in revenues_dict.items()]
+    return {
+        'data': data,
+        'total': {'to_invoice': total_to_invoice, 'invoiced': total_invoiced},
+    }
+
+
+@tagged('post_install', '-at_install')
+class TestProjectProfitability(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.partner = cls.env['res.partner'].create({'name': 'Profitability Customer'})
+        cls.project_a, cls.project_b, cls.project_c = cls.env['project.project'].create([{
+            'name': name,
+            'partner_id': cls.partner.id,
+            'allow_billable': True,
+        } for name in ('Project A', 'Project B', 'Project C')])
+        cls.product_storable, cls.product_service, cls.product_material = cls.env['product.product'].create([{
+            'name': 'Storable Service',
+            'type': 'product',
+            'invoice_policy': 'order',
+            'service_type': 'manual',
+            'list_price': 90.0,
+        }, {
+            'name': 'Manual Service',
+            'type': 'service',
+            'invoice_policy': 'order',
+            'service_type': 'manual',
+            'list_price': 45.0,
+        }, {
+            'name': 'Material',
+            'type': 'consu',
+            'invoice_policy': 'order',
+            'list_price': 12.5,
+        }])
+
+    def _create_order(self, products):
+        order = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+            'order_line': [Command.create({'product_id': product.id, 'product_uom_qty': qty}) for product, qty in products],
+        })
+        order.action_confirm()
+        return order
+
+    def _get_panel_revenues(self, project):
+        """ Revenues of the project computed as its profitability panel does """
+        sale_items = project.sudo()._get_sale_order_items()
+        domain = [
+            ('order_id', 'in', sale_items.order_id.ids),
+            '|',
+                '|',
+                    ('project_id', 'in', project.ids),
+                    ('project_id', '=', False),
+                ('id', 'in', sale_items.ids),
+        ]
+        return project._get_revenues_items_from_sol(domain, with_action=False)
+
+    def assertRevenuesAlmostEqual(self, revenues, expected_revenues):
+        self.assertEqual([revenue['id'] for revenue in revenues['data']], [revenue['id'] for revenue in expected_revenues['data']])
+        for revenue, expected_revenue in zip(revenues['data'], expected_revenues['data']):
+            self.assertEqual(revenue['sequence'], expected_revenue['sequence'])
+            self.assertAlmostEqual(revenue['to_invoice'], expected_revenue['to_invoice'])
+            self.assertAlmostEqual(revenue['invoiced'], expected_revenue['invoiced'])
+        self.assertAlmostEqual(revenues['total']['to_invoice'], expected_revenues['total']['to_invoice'])
+        self.assertAlmostEqual(revenues['total']['invoiced'], expected_revenues['total']['invoiced'])
+
+    def _create_sale_items(self):
+        order_1 = self._create_order([
+            (self.product_storable, 2), (self.product_service, 3), (self.product_material, 7), (self.product_storable, 1),
+        ])
+        order_2 = self._create_order([(self.product_service, 5), (self.product_material, 4)])
+        sol_storable, sol_service, __, sol_other_project = order_1.order_line
+        # a sale order item of project A generated for project C, and an item of order 1 belonging to project B
+        sol_storable.project_id = self.project_c
+        sol_other_project.project_id = self.project_b
+        self.project_a.sale_line_id = sol_storable
+        self.project_b.sale_line_id = order_2.order_line[0]
+        self.env['project.task'].create([{
+            'name': 'Task A',
+            'project_id': self.project_a.id,
+            'partner_id': self.partner.id,
+            'sale_line_id': order_2.order_line[1].id,
+        }, {
+            'name': 'Task B',
+            'project_id': self.project_b.id,
+            'partner_id': self.partner.id,
+            'sale_line_id': sol_service.id,
+        }])
+        return order_1, order_2
+
+    def test_revenues_per_project_match_panel(self):
+        self._create_sale_items()
+        projects = self.project_a | self.project_b | self.project_c
+        revenues_per_project = projects._get_revenues_items_from_sol_per_project(use_snapshot=False)
+        self.assertEqual(set(revenues_per_project), set(projects.ids))
+        self.assertTrue(revenues_per_project[self.project_a.id]['data'])
+        for project in projects:
+            self.assertRevenuesAlmostEqual(revenues_per_project[project.id], self._get_panel_revenues(project))
+
+    def test_snapshot_follows_changes(self):
+        order_1, order_2 = self._create_sale_items()
+        projects = self.project_a | self.project_b | self.project_c
+        projects._rebuild_profitability_snapshot()
+        self.assertEqual(projects._filter_fresh_profitability_snapshot(), projects)
+
+        def assertSnapshotMatchesPanel():
+            revenues_per_project = projects._get_revenues_items_from_snapshot()
+            for project in projects:
+                self.assertRevenuesAlmostEqual(revenues_per_project[project.id], self._get_panel_revenues(project))
+
+        assertSnapshotMatchesPanel()
+        # changes of the sale order items are applied as deltas
+        order_1.order_line[2].product_uom_qty = 11
+        order_2.order_line[1].price_unit = 20.0
+        order_1.write({'order_line': [Command.create({'product_id': self.product_material.id, 'product_uom_qty': 2})]})
+        assertSnapshotMatchesPanel()
+        # the sale order items without amount still count, as in the live computation
+        order_1.order_line[1].price_unit = 0.0
+        assertSnapshotMatchesPanel()
+        # changes of the sale items of the projects bring in or take out the items of their orders
+        self.env['project.task'].create({
+            'name': 'Task C',
+            'project_id': self.project_c.id,
+            'partner_id': self.partner.id,
+            'sale_line_id': order_2.order_line[0].id,
+        })
+        self.project_a.sale_line_id = False
+        assertSnapshotMatchesPanel()
+        self.env['project.task'].search([('project_id', '=', self.project_b.id)]).unlink()
+        self.env.cr.precommit.run()
+        assertSnapshotMatchesPanel()
+        self.assertEqual(projects._filter_fresh_profitability_snapshot(), projects)
+
+    def test_sale_items_changes_without_snapshot(self):
+        self.env['project.project'].search([('profitability_snapshot_date', '!=', False)]).profitability_snapshot_date = False
+        Snapshot = type(self.env['project.profitability.snapshot'])
+        with patch.object(Snapshot, '_read_sale_line_rows', autospec=True) as read_sale_line_rows:
+            order_1, __ = self._create_sale_items()
+            order_1.order_line[2].product_uom_qty = 11
+            order_1.order_line[1].price_unit = 20.0
+            self.env.flush_all()
+        read_sale_line_rows.assert_not_called()
+
+    def test_panel_reads_snapshot(self):
+        self._create_sale_items()
+        live_revenues = self.project_a._get_profitability_items(False)['revenues']
+        self.project_a._rebuild_profitability_snapshot()
+        # the panel no longer reads the amounts of the sale order items
+        self.env['project.profitability.snapshot'].search([('project_id', '=', self.project_a.id)]).to_invoice = 0.0
+        snapshot_revenues = self.project_a._get_profitability_items(False)['revenues']
+        self.assertNotEqual(snapshot_revenues['total'], live_revenues['total'])
+        self.assertEqual([revenue['id'] for revenue in snapshot_revenues['data']], [revenue['id'] for revenue in live_revenues['data']])
+
+    def test_cron_rebuilds_snapshots_before_expiry(self):
+        projects = self.project_a | self.project_b
+        projects._rebuild_profitability_snapshot()
+        max_age = self.env['project.project']._get_profitability_snapshot_max_age()
+        rebuilt_date = fields.Datetime.now() - timedelta(hours=max_age * 2 / 3)
+        self.project_a.profitability_snapshot_date = rebuilt_date
+        self.env['project.project']._cron_rebuild_profitability_snapshots()
+        self.assertGreater(self.project_a.profitability_snapshot_date, rebuilt_date)
+        self.assertEqual(projects._filter_fresh_profitability_snapshot(), projects)
+
+    def test_revenues_match_reference_on_large_project(self):
+        # a few thousand products spread over all the (type, invoice policy, service type) groups
+        product_groups = list(cartesian_product(['product', 'service', 'consu'], ['order'], ['manual', 'timesheet', 'milestones']))
+        products = self.env['product.product'].create([{
+            'name': f'Synthetic Product {index}',
+            'type': type_,
+            'invoice_policy': invoice_policy,
+            'service_type': service_type,
+            'list_price': 1.0 + index % 97 / 7,
+        } for index, (type_, invoice_policy, service_type) in zip(range(2000), cycle(product_groups))])
+        order = self._create_order([(product, 1 + index % 5) for index, product in enumerate(products)])
+        domain = [('order_id', '=', order.id)]
+
+        revenues = self.project_a._get_revenues_items_from_sol(domain)
+        self.assertEqual(len(revenues['data']), len({revenue['id'] for revenue in revenues['data']}))
+        self.assertEqual(revenues, get_revenues_items_from_sol_reference(self.project_a, domain))
+        self.assertEqual(
+            self.project_a._get_revenues_items_from_sol(domain, with_action=False),
+            get_revenues_items_from_sol_reference(self.project_a, domain, with_action=False),
+        )
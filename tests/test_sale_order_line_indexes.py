@@ -0,0 +1,85 @@
+from odoo import Command
+from odoo.tests import TransactionCase, tagged
+from odoo.tools import SQL
+from odoo.tools.safe_eval import safe_eval
+
+from .common import clone_records
+
+
+@tagged('post_install', '-at_install')
+class TestSaleOrderLineIndexes(TransactionCase):
+    """ On a large table, the planner picks the partial indexes of the module for the domains looking up
+        the confirmed sales order items of a customer.
+    """
+    PARTNERS = 500
+    LINES = 100000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.partners = cls.env['res.partner'].create([{'name': f'Index Customer {index}'} for index in range(cls.PARTNERS)])
+        product = cls.env['product.product'].create({
+            'name': 'Storable Service',
+            'type': 'product',
+            'invoice_policy': 'order',
+            'service_type': 'manual',
+            'uom_id': cls.env.ref('uom.product_uom_hour').id,
+            'uom_po_id': cls.env.ref('uom.product_uom_hour').id,
+        })
+        order = cls.env['sale.order'].create({
+            'partner_id': cls.partners[0].id,
+            'order_line': [Command.create({'product_id': product.id, 'product_uom_qty': 10})],
+        })
+        order.action_confirm()
+        # spread over the partners, one in ten confirmed and half of these with remaining hours
+        clone_records(order.order_line, cls.LINES, values={
+            'order_partner_id': '(%(partner_ids)s::int[])[1 + serie %% %(partner_count)s]',
+            'state': "CASE WHEN serie %% 10 = 0 THEN 'sale' ELSE 'draft' END",
+            'remaining_hours': 'CASE WHEN serie %% 20 = 0 THEN 1.0 ELSE 0.0 END',
+        }, params={'partner_ids': cls.partners.ids, 'partner_count': len(cls.partners)})
+        cls.env.cr.execute("ANALYZE sale_order_line")
+
+    def _eval_field_domain(self, domain, **values):
+        # as the web client does with the domain of a field, given the values of the record
+        return safe_eval(str(domain), values)
+
+    def _explain(self, domain):
+        query = self.env['sale.order.line'].sudo()._search(domain)
+        self.env.cr.execute(SQL("EXPLAIN %s", query.select()))
+        return '\n'.join(row for row, in self.env.cr.fetchall())
+
+    def test_last_sol_of_customer_uses_remaining_hours_index(self):
+        # domain of ProjectTask._get_last_sol_of_customer and Project._compute_sale_line_id
+        plan = self._explain([
+            ('company_id', '=', self.env.company.id),
+            ('order_partner_id', 'child_of', self.partners[42].ids),
+            ('is_expense', '=', False),
+            ('state', '=', 'sale'),
+            ('remaining_hours', '>', 0),
+        ])
+        self.assertIn('sale_order_line_partner_remaining_hours_no_expense_index', plan)
+
+    def test_sale_line_domain_uses_confirmed_index(self):
+        # domain of the sales order item fields of projects, timesheets and employee mappings
+        plan = self._explain([
+            ('order_partner_id', 'child_of', self.partners[42].ids),
+            ('is_expense', '=', False),
+            ('state', '=', 'sale'),
+        ])
+        self.assertIn('sale_order_line_partner_confirmed_index', plan)
+
+    def test_project_sale_line_domain_uses_confirmed_index(self):
+        plan = self._explain(self._eval_field_domain(
+            self.env['project.project']._domain_sale_line_id(), partner_id=self.partners[42].id))
+        self.assertIn('sale_order_line_partner_confirmed_index', plan)
+
+    def test_employee_mapping_sale_line_domain_uses_confirmed_index(self):
+        plan = self._explain(self._eval_field_domain(
+            self.env['project.sale.line.employee.map']._domain_sale_line_id(), partner_id=self.partners[42].id))
+        self.assertIn('sale_order_line_partner_confirmed_index', plan)
+
+    def test_timesheet_sale_line_domain_uses_confirmed_index(self):
+        # the customer is matched through its commercial partner
+        plan = self._explain(self._eval_field_domain(
+            self.env['account.analytic.line']._domain_so_line(), commercial_partner_id=self.partners[42].id))
+        self.assertIn('sale_order_line_partner_confirmed_index', plan)
@@ -0,0 +1,110 @@
+from unittest.mock import patch
+
+from odoo import Command
+from odoo.tests import TransactionCase, tagged
+from odoo.tools import float_compare
+
+
+@tagged('post_install', '-at_install')
+class TestSaleOrderUpsell(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.partner = cls.env['res.partner'].create({'name': 'Upsell Customer'})
+        uom_hour = cls.env.ref('uom.product_uom_hour')
+        cls.product_no_threshold, cls.product_threshold, cls.product_service = cls.env['product.product'].create([{
+            'name': 'Storable Prepaid',
+            'type': 'product',
+            'service_upsell_threshold': 0.0,
+        }, {
+            'name': 'Storable Prepaid Threshold',
+            'type': 'product',
+            'service_upsell_threshold': 0.5,
+        }, {
+            'name': 'Service Prepaid',
+            'type': 'service',
+            'service_upsell_threshold': 0.0,
+        }])
+        (cls.product_no_threshold | cls.product_threshold | cls.product_service).write({
+            'invoice_policy': 'order',
+            'service_type': 'manual',
+            'uom_id': uom_hour.id,
+            'uom_po_id': uom_hour.id,
+        })
+
+    def _get_lines_to_upsell_reference(self, order):
+        """ The lines to upsell as filtered before the single query, with float_compare """
+        precision = self.env['decimal.precision'].precision_get('Product Unit of Measure')
+        return order.order_line.filtered(lambda sol:
+            sol.product_id.type in ['service', 'product']
+            and sol.invoice_status != "invoiced"
+            and not sol.has_displayed_warning_upsell
+            and sol.product_id.service_policy == 'ordered_prepaid'
+            and float_compare(
+                sol.qty_delivered,
+                sol.product_uom_qty * (sol.product_id.service_upsell_threshold or 1.0),
+                precision_digits=precision
+            ) > 0
+        )
+
+    def _create_order(self, lines):
+        order = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+            'order_line': [Command.create({'product_id': product.id, 'product_uom_qty': qty}) for product, qty, __ in lines],
+        })
+        order.action_confirm()
+        return order
+
+    def test_lines_to_upsell_match_float_compare(self):
+        precision = self.env['decimal.precision'].precision_get('Product Unit of Measure')
+        self.assertEqual(precision, 2)
+        # (product, ordered, delivered): on both sides of the threshold, of its rounding and of a 0 threshold
+        lines_per_order = [[
+            (self.product_no_threshold, 1.0, 1.0),
+            (self.product_no_threshold, 1.0, 1.004),
+            (self.product_no_threshold, 1.0, 1.005),
+            (self.product_no_threshold, 1.0, 1.01),
+            (self.product_service, 2.0, 2.004),
+            (self.product_service, 2.0, 2.006),
+        ], [
+            (self.product_threshold, 3.0, 1.5),
+            (self.product_threshold, 3.0, 1.504),
+            (self.product_threshold, 3.0, 1.505),
+            (self.product_threshold, 3.0, 1.51),
+            (self.product_threshold, 0.35, 0.175),
+            (self.product_threshold, 0.35, 0.176),
+        ], [
+            (self.product_no_threshold, 5.0, 4.0),
+        ]]
+        orders = self.env['sale.order']
+        for lines in lines_per_order:
+            order = self._create_order(lines)
+            for sol, (__, __, delivered) in zip(order.order_line, lines):
+                sol.with_context(mail_activity_automation_skip=True).qty_delivered = delivered
+            orders |= order
+        self.env.flush_all()
+
+        lines_per_order = orders._get_prepaid_service_lines_to_upsell_per_order()
+        for order in orders:
+            expected_lines = self._get_lines_to_upsell_reference(order)
+            self.assertEqual(lines_per_order.get(order, self.env['sale.order.line']), expected_lines)
+            self.assertEqual(order._get_prepaid_service_lines_to_upsell(), expected_lines)
+        self.assertEqual(len(lines_per_order), 2, "The last order has nothing to upsell")
+        self.assertEqual(lines_per_order[orders[0]], orders[0].order_line[2:4] | orders[0].order_line[5])
+        self.assertEqual(lines_per_order[orders[1]], orders[1].order_line[2:4])
+
+    def test_upsell_reads_lines_once_for_all_orders(self):
+        orders = self._create_order([(self.product_no_threshold, 1.0, 0.0)]) \
+            | self._create_order([(self.product_service, 1.0, 0.0)])
+        SaleOrder = type(self.env['sale.order'])
+        get_lines_per_order = SaleOrder._get_prepaid_service_lines_to_upsell_per_order
+        with patch.object(SaleOrder, '_get_prepaid_service_lines_to_upsell_per_order',
+                          autospec=True, side_effect=get_lines_per_order) as lines_per_order_mock, \
+                patch.object(SaleOrder, '_get_prepaid_service_lines_to_upsell', autospec=True) as lines_mock:
+            orders.order_line.qty_delivered = 2.0
+            self.env.flush_all()
+        self.assertEqual(lines_per_order_mock.call_count, 1)
+        self.assertFalse(lines_mock.called)
+        self.assertTrue(all(orders.order_line.mapped('has_displayed_warning_upsell')))
+        self.assertEqual(orders.mapped('invoice_status'), ['upselling', 'upselling'])
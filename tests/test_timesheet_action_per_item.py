@@ -0,0 +1,93 @@
+import logging
+import time
+
+from odoo import Command
+from odoo.tests import TransactionCase, new_test_user, tagged
+
+from .common import clone_records
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install')
+class TestTimesheetActionPerItem(TransactionCase):
+    """ The action of the sales order items only reads the number of their timesheets and one of them,
+        whatever the number of timesheets.
+    """
+    TIMESHEETS = 50000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = new_test_user(
+            cls.env, login='storable_service_timesheet_user',
+            groups='hr_timesheet.group_hr_timesheet_user,sales_team.group_sale_salesman',
+        )
+        cls.partner = cls.env['res.partner'].create({'name': 'Timesheet Customer'})
+        cls.project = cls.env['project.project'].create({
+            'name': 'Timesheet Project',
+            'partner_id': cls.partner.id,
+            'allow_billable': True,
+            'allow_timesheets': True,
+        })
+        cls.employee = cls.env['hr.employee'].create({'name': 'Timesheet Employee'})
+        product = cls.env['product.product'].create({
+            'name': 'Storable Timesheet',
+            'type': 'product',
+            'invoice_policy': 'delivery',
+            'service_type': 'timesheet',
+            'service_tracking': 'task_global_project',
+            'project_id': cls.project.id,
+            'uom_id': cls.env.ref('uom.product_uom_hour').id,
+            'uom_po_id': cls.env.ref('uom.product_uom_hour').id,
+        })
+        cls.order = cls.env['sale.order'].create({
+            'partner_id': cls.partner.id,
+            'order_line': [Command.create({'product_id': product.id, 'product_uom_qty': 10}) for __ in range(2)],
+        })
+        cls.order.action_confirm()
+        cls.sol_many, cls.sol_single = cls.order.order_line
+        cls.timesheet_single = cls._create_timesheet(cls.sol_single)
+        timesheet = cls._create_timesheet(cls.sol_many)
+        clone_records(timesheet, cls.TIMESHEETS - 1)
+
+    @classmethod
+    def _create_timesheet(cls, sol):
+        return cls.env['account.analytic.line'].create({
+            'name': 'Timesheet',
+            'project_id': cls.project.id,
+            'task_id': sol.task_id.id,
+            'employee_id': cls.employee.id,
+            'unit_amount': 0.1,
+        })
+
+    def _get_action_per_item(self, sols):
+        """ Return the action per item of the sales order items, read with an empty cache, with the number
+            of queries it took
+        """
+        self.env.flush_all()
+        self.env.invalidate_all()
+        query_count = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        action_per_sol = sols._get_action_per_item()
+        duration = time.perf_counter() - start
+        query_count = self.env.cr.sql_log_count - query_count
+        _logger.info("Action of %s sales order items with %s timesheets: %s queries, %.3fs", len(sols),
+                     self.env['account.analytic.line'].search_count([('so_line', 'in', sols.ids)]), query_count, duration)
+        return action_per_sol, query_count
+
+    def test_action_per_item_with_many_timesheets(self):
+        sols = self.order.order_line.with_user(self.user)
+        self.assertEqual(self.env['account.analytic.line'].search_count([('so_line', '=', self.sol_many.id)]), self.TIMESHEETS)
+        timesheet_action = self.env.ref('sale_timesheet.timesheet_action_from_sales_order_item').id
+
+        action_per_sol, query_count = self._get_action_per_item(sols)
+        self.assertEqual(action_per_sol, {
+            self.sol_many.id: (timesheet_action, False),
+            self.sol_single.id: (timesheet_action, self.timesheet_single.id),
+        })
+        # the timesheets are counted, not loaded: the items with one timesheet or 50,000 take the same queries
+        __, single_query_count = self._get_action_per_item(sols - sols.browse(self.sol_many.id))
+        __, many_query_count = self._get_action_per_item(sols - sols.browse(self.sol_single.id))
+        self.assertEqual(many_query_count, single_query_count)
+        self.assertEqual(query_count, single_query_count)
@@ -0,0 +1,152 @@
+import logging
+import time
+from collections import defaultdict
+from unittest.mock import patch
+
+from odoo import Command
+from odoo.exceptions import UserError
+from odoo.tests import TransactionCase, tagged
+
+from ..models import sale_order_line
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('post_install', '-at_install')
+class TestTimesheetServiceGeneration(TransactionCase):
+    """ Generation of the projects and tasks of the orders, with the benchmark of the confirmation of an
+        order of 1,000 lines creating projects from several templates.
+    """
+    LINES = 1000
+    TEMPLATES = 10
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.partner = cls.env['res.partner'].create({'name': 'Benchmark Customer'})
+        cls.project_templates = cls.env['project.project'].create([{
+            'name': f'Template {index}',
+            'allow_timesheets': True,
+        } for index in range(cls.TEMPLATES)])
+        uom_hour = cls.env.ref('uom.product_uom_hour')
+        cls.products = cls.env['product.product'].create([{
+            'name': f'Storable {service_tracking} {template.name}',
+            'type': type_,
+            'invoice_policy': 'order',
+            'service_type': 'manual',
+            'service_tracking': service_tracking,
+            'project_template_id': template.id,
+            'uom_id': uom_hour.id,
+            'uom_po_id': uom_hour.id,
+        } for template in cls.project_templates
+          for type_, service_tracking in [('product', 'task_in_project'), ('service', 'project_only')]])
+        cls.product_project = cls.env['product.product'].create({
+            'name': 'Storable project_only',
+            'type': 'product',
+            'invoice_policy': 'order',
+            'service_type': 'manual',
+            'service_tracking': 'project_only',
+            'uom_id': uom_hour.id,
+            'uom_po_id': uom_hour.id,
+        })
+
+    def _create_order(self, products):
+        return self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+            'order_line': [Command.create({'product_id': product.id, 'product_uom_qty': 2}) for product in products],
+        })
+
+    def test_confirm_large_order(self):
+        order = self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+            'order_line': [Command.create({
+                'product_id': self.products[index % len(self.products)].id,
+                'product_uom_qty': 1 + index % 3,
+            }) for index in range(self.LINES)],
+        })
+        expected_hours_per_template = defaultdict(float)
+        for line in order.order_line:
+            expected_hours_per_template[line.product_id.project_template_id] += line.product_uom_qty
+
+        SaleOrderLine = type(self.env['sale.order.line'])
+        get_allocated_hours = SaleOrderLine._get_allocated_hours_per_project_template
+        with patch.object(SaleOrderLine, '_get_allocated_hours_per_project_template',
+                          autospec=True, side_effect=get_allocated_hours) as allocated_hours_mock:
+            start = time.perf_counter()
+            order.action_confirm()
+            duration = time.perf_counter() - start
+        _logger.info("Confirmation of an order of %s lines: %.2fs", self.LINES, duration)
+
+        self.assertEqual(allocated_hours_mock.call_count, 1, "The hours should be allocated once for the order")
+        projects = order.order_line.project_id
+        self.assertEqual(len(projects), self.TEMPLATES, "One project should be created per project template")
+        for line in order.order_line:
+            self.assertAlmostEqual(
+                line.project_id.allocated_hours,
+                expected_hours_per_template[line.product_id.project_template_id],
+            )
+
+    def test_confirm_orders_creates_projects_at_once(self):
+        orders = self._create_order(self.product_project) \
+            | self._create_order(self.product_project) \
+            | self._create_order(self.product_project)
+        orders[2].order_line.product_uom_qty = 3
+        Project = type(self.env['project.project'])
+        create = Project.create
+        with patch.object(Project, 'create', autospec=True, side_effect=create) as create_mock:
+            orders.action_confirm()
+
+        self.assertEqual(create_mock.call_count, 1, "The projects without template should be created together")
+        for order, allocated_hours in zip(orders, [2, 2, 3]):
+            project = order.order_line.project_id
+            self.assertEqual(project.sale_line_id, order.order_line)
+            self.assertEqual(project.allocated_hours, allocated_hours)
+            self.assertEqual(len(project.type_ids), 4)
+        self.assertEqual(len(orders.order_line.project_id), 3)
+
+    def test_deferred_generation(self):
+        self.env['ir.config_parameter'].sudo().set_param('storable_service.deferred_generation_min_lines', 3)
+        small_order = self._create_order(self.product_project | self.products[0])
+        order = self._create_order(self.product_project | self.products[0] | self.products[3])
+        (small_order | order).action_confirm()
+
+        self.assertFalse(small_order.service_generation_state, "An order below the threshold is generated right away")
+        self.assertEqual(len(small_order.order_line.project_id), 2)
+        self.assertEqual(set(order.order_line.mapped('service_generation_state')), {'pending'})
+        self.assertEqual(order.service_generation_state, 'pending')
+        self.assertFalse(order.order_line.project_id)
+
+        self.env['sale.order.line']._cron_generate_pending_services()
+        self.assertEqual(order.service_generation_state, 'done')
+        projects = order.order_line.project_id
+        self.assertEqual(len(projects), 3)
+        self.assertTrue(order.order_line[1].task_id)
+
+        # the lines marked as done are not generated again
+        SaleOrderLine = type(self.env['sale.order.line'])
+        with patch.object(SaleOrderLine, '_timesheet_service_generation', autospec=True) as generation_mock:
+            self.env['sale.order.line']._cron_generate_pending_services()
+        generation_mock.assert_not_called()
+        self.assertEqual(order.order_line.project_id, projects)
+
+    def test_failed_generation(self):
+        self.env['ir.config_parameter'].sudo().set_param('storable_service.deferred_generation_min_lines', 1)
+        order = self._create_order(self.product_project)
+        order.action_confirm()
+        self.assertEqual(order.service_generation_state, 'pending')
+
+        SaleOrderLine = type(self.env['sale.order.line'])
+        with patch.object(SaleOrderLine, '_timesheet_create_new_projects', side_effect=UserError("Generation failed")), \
+                self.assertLogs(sale_order_line._logger, 'ERROR'):
+            self.env['sale.order.line']._cron_generate_pending_services()
+        self.assertEqual(order.service_generation_state, 'failed')
+        self.assertFalse(order.order_line.project_id)
+
+        # the failed lines are left alone by the next runs, until the generation is retried from the order
+        self.env['sale.order.line']._cron_generate_pending_services()
+        self.assertEqual(order.service_generation_state, 'failed')
+        order.action_retry_service_generation()
+        self.assertEqual(order.service_generation_state, 'pending')
+        self.env['sale.order.line']._cron_generate_pending_services()
+        self.assertEqual(order.service_generation_state, 'done')
+        self.assertTrue(order.order_line.project_id)